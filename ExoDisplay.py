@@ -1,11 +1,15 @@
-from psychopy import visual, core
+from psychopy import core
+# psychopy.visual is imported where stims are built, so headless runs
+# (replay, benchmarks) never load the graphics stack
 import numpy as np
-import yaml, math
-
-def gen_key_shape(win, width=0.1, height=0.05,
-        corner_rad=0.02, line_width=2.5, corner_pts=5,
-        fill_color=[-0.5,-0.5,-0.5], line_color=[0.1,0.1,0.1],
-        xpos=0, ypos=0):
+import yaml, math, functools
+from collections import deque
+from exo_input import ExoAcquisition
+
+@functools.lru_cache(maxsize=None)
+def key_shape_vertices(width=0.1, height=0.05, corner_rad=0.02, corner_pts=5):
+    # rounded rectangle outline, computed once per geometry and shared
+    # (read-only) between every stim that uses it
     num_circ_points = 4*corner_pts+5
     circ_points = np.linspace(0,2*np.pi,num=num_circ_points)
     cxs = corner_rad*np.cos(circ_points)
@@ -22,6 +26,26 @@ def gen_key_shape(win, width=0.1, height=0.05,
     ys[2*qts:3*qts] = cys[2*qts-2:3*qts-2]-0.5*height
     ys[3*qts:4*qts] = cys[3*qts-3:4*qts-3]-0.5*height
     vertices = np.vstack([xs,ys]).T
+    vertices.flags.writeable = False
+    return vertices
+
+class NullStim:
+    # stands in for a psychopy stim when running without a window (headless)
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def draw(self):
+        pass
+
+def gen_key_shape(win, width=0.1, height=0.05,
+        corner_rad=0.02, line_width=2.5, corner_pts=5,
+        fill_color=[-0.5,-0.5,-0.5], line_color=[0.1,0.1,0.1],
+        xpos=0, ypos=0, vertices=None):
+    if vertices is None:
+        vertices = key_shape_vertices(width, height, corner_rad, corner_pts)
+    if win is None:
+        return NullStim(vertices=vertices, pos=(xpos,ypos))
+    from psychopy import visual
     shape = visual.ShapeStim(win,
         vertices=vertices,
         lineWidth=line_width,
@@ -30,43 +54,132 @@ def gen_key_shape(win, width=0.1, height=0.05,
         pos=(xpos,ypos), interpolate=True)
     return shape
 
-class KeyDisplay:
-    def __init__(self, key_width, key_height,
-            base_expand, base_height,
-            corner_rad, line_width, corner_pts,
-            color, shadow_adjust_color, line_color, line_adjust_color,
-            xpos, ypos, win):
+class ChangeTracker:
+    # remembers the last value given to each setter, so unchanged values skip
+    # the psychopy setter (and the upload/re-layout behind it); updates counts
+    # the setters that really ran. With deferred set, setters only record
+    # their value, and apply_values() (called on the render thread with a
+    # copy of last_values) makes the recorded values take effect
+    def __init__(self):
+        self.last_values = {}
+        self.applied_values = {}
+        self.updates = 0
+        self.deferred = False
+
+    def set(self, name, value):
+        recorded = tuple(value) if np.ndim(value) else value
+        if self.last_values.get(name) == recorded:
+            return
+        self.last_values[name] = recorded
+        self.updates += 1
+        if not(self.deferred):
+            self.applied_values[name] = recorded
+            self.apply(name, value)
+
+    def apply_values(self, values):
+        for name, value in values.items():
+            if self.applied_values.get(name) != value:
+                self.applied_values[name] = value
+                self.apply(name, value)
+
+class TextCache:
+    # one prebuilt TextStim per (text, color), so switching message is a
+    # pointer swap instead of a text re-layout and texture rebuild
+    def __init__(self, win, pos, height):
+        self.win = win
+        self.pos = pos
+        self.height = height
+        self.stims = {}
+
+    def key(self, text, color):
+        if text == '':
+            return ('', None) # nothing to render, colour irrelevant
+        return (text, tuple(color))
+
+    def get(self, text, color):
+        key = self.key(text, color)
+        stim = self.stims.get(key)
+        if stim is None and self.win is None:
+            stim = self.stims[key] = NullStim(text=text, color=color)
+        elif stim is None:
+            from psychopy import visual
+            stim = visual.TextStim(win=self.win,
+                text=text, pos=self.pos,
+                color=color,
+                height=self.height)
+            self.stims[key] = stim
+        return stim
+
+    def prepare(self, texts, color):
+        for text in texts:
+            self.get(text, color)
+
+    def warm_up(self):
+        # draw every cached stim once, so its texture exists before it is shown
+        for stim in self.stims.values():
+            stim.draw()
+
+class KeyTemplate:
+    # key and base outlines shared by every key built from the template
+    def __init__(self, key_width, key_height, base_expand, corner_rad, corner_pts):
+        self.key_vertices = key_shape_vertices(key_width, key_height,
+            corner_rad, corner_pts)
+        self.base_vertices = key_shape_vertices(key_width+base_expand,
+            key_height+base_expand, corner_rad+base_expand, corner_pts)
+
+    def build_keys(self, xpos, ypos, base_height, line_width,
+            color, shadow_adjust_color, line_color, line_adjust_color, win):
+        return [KeyDisplay(template=self, base_height=base_height,
+            line_width=line_width, color=color,
+            shadow_adjust_color=shadow_adjust_color,
+            line_color=line_color, line_adjust_color=line_adjust_color,
+            xpos=x, ypos=ypos, win=win) for x in xpos]
+
+class KeyDisplay(ChangeTracker):
+    def __init__(self, key_width=None, key_height=None,
+            base_expand=None, base_height=None,
+            corner_rad=None, line_width=None, corner_pts=None,
+            color=None, shadow_adjust_color=None, line_color=None, line_adjust_color=None,
+            xpos=0, ypos=0, win=None, template=None):
+        ChangeTracker.__init__(self)
+        if template is None:
+            template = KeyTemplate(key_width, key_height, base_expand,
+                corner_rad, corner_pts)
         self.shadow_adjust_color = np.array(shadow_adjust_color)
         self.line_adjust_color = np.array(line_adjust_color)
-        self.key_top = gen_key_shape(win, width=key_width, height=key_height,
-            corner_rad=corner_rad, line_width=line_width, corner_pts=corner_pts,
+        self.key_top = gen_key_shape(win, line_width=line_width,
             fill_color=color, line_color=line_color,
-            xpos=xpos, ypos=ypos)
-        self.key_bottom = gen_key_shape(win, width=key_width, height=key_height,
-            corner_rad=corner_rad, line_width=line_width, corner_pts=corner_pts,
+            xpos=xpos, ypos=ypos, vertices=template.key_vertices)
+        self.key_bottom = gen_key_shape(win, line_width=line_width,
             fill_color=np.array(color)+self.shadow_adjust_color, line_color=line_color,
-            xpos=xpos, ypos=ypos)
-        self.base_top = gen_key_shape(win, width=key_width+base_expand, height=key_height+base_expand,
-            corner_rad=corner_rad+base_expand, line_width=line_width, corner_pts=corner_pts,
+            xpos=xpos, ypos=ypos, vertices=template.key_vertices)
+        self.base_top = gen_key_shape(win, line_width=line_width,
             fill_color=color, line_color=line_color,
-            xpos=xpos, ypos=ypos)
-        self.base_bottom = gen_key_shape(win, width=key_width+base_expand, height=key_height+base_expand,
-            corner_rad=corner_rad+base_expand, line_width=line_width, corner_pts=corner_pts,
+            xpos=xpos, ypos=ypos, vertices=template.base_vertices)
+        self.base_bottom = gen_key_shape(win, line_width=line_width,
             fill_color=np.array(color)+self.shadow_adjust_color, line_color=line_color,
-            xpos=xpos, ypos=ypos-base_height)
+            xpos=xpos, ypos=ypos-base_height, vertices=template.base_vertices)
 
     def setKeyColor(self, color):
-        self.key_top.fillColor = np.array(color)
-        self.key_bottom.fillColor = np.array(color)+self.shadow_adjust_color
+        self.set('key_color', color)
 
     def setBaseColor(self, color):
-        self.base_top.fillColor = np.array(color)
-        self.base_bottom.fillColor = np.array(color)+self.shadow_adjust_color
-        self.base_top.lineColor = np.array(color)+self.line_adjust_color
-        self.base_bottom.lineColor = np.array(color)+self.line_adjust_color
+        self.set('base_color', color)
 
     def setPos(self, ypos):
-        self.key_top.pos = [self.key_top.pos[0], ypos]
+        self.set('ypos', ypos)
+
+    def apply(self, name, value):
+        if name == 'key_color':
+            self.key_top.fillColor = np.array(value)
+            self.key_bottom.fillColor = np.array(value)+self.shadow_adjust_color
+        elif name == 'base_color':
+            self.base_top.fillColor = np.array(value)
+            self.base_bottom.fillColor = np.array(value)+self.shadow_adjust_color
+            self.base_top.lineColor = np.array(value)+self.line_adjust_color
+            self.base_bottom.lineColor = np.array(value)+self.line_adjust_color
+        elif name == 'ypos':
+            self.key_top.pos = [self.key_top.pos[0], value]
 
     def draw(self):
         self.base_bottom.draw()
@@ -75,36 +188,185 @@ class KeyDisplay:
         self.key_top.draw()
 
 
-class CueDisplay:
+class KeyboardRenderer:
+    # draws every key of a row from one shared vertex/colour buffer: one
+    # glDrawArrays per layer for the fills and one for the outlines, instead
+    # of two draws per ShapeStim
+
+    LAYERS = ('base_bottom', 'base_top', 'key_bottom', 'key_top') # draw order
+
+    def __init__(self, template, xpos, ypos, base_height, line_width,
+            color, shadow_adjust_color, line_color, line_adjust_color, win):
+        self.win = win
+        self.line_width = line_width
+        self.shadow_adjust_color = np.array(shadow_adjust_color)
+        self.line_adjust_color = np.array(line_adjust_color)
+        self.num_keys = len(xpos)
+        n = self.num_keys
+
+        # per-shape local geometry: a triangle fan from the centre for the
+        # fill (the outline is convex) followed by closed-loop line segments
+        outlines = [template.base_vertices, template.base_vertices,
+                    template.key_vertices, template.key_vertices]
+        shapes = []
+        self.layer_ranges = [] # (first fill, fill count, first line, line count)
+        first = 0
+        for layer, outline in enumerate(outlines):
+            nxt = np.roll(outline, -1, axis=0)
+            fill = np.stack([np.zeros_like(outline), outline, nxt], axis=1).reshape(-1,2)
+            line = np.stack([outline, nxt], axis=1).reshape(-1,2)
+            local = np.vstack([np.tile(fill, (n,1)), np.tile(line, (n,1))])
+            shapes.append(local)
+            self.layer_ranges.append((first, n*len(fill),
+                                      first+n*len(fill), n*len(line)))
+            first += len(local)
+        self.local_vertices = np.vstack(shapes)
+        self.num_vertices = len(self.local_vertices)
+
+        # shape index -> slices of its fill and line vertices
+        self.fill_slices = {}
+        self.line_slices = {}
+        for layer, (fill_first, fill_count, line_first, line_count) in enumerate(self.layer_ranges):
+            fill_len = fill_count//n
+            line_len = line_count//n
+            for key in range(n):
+                self.fill_slices[(layer, key)] = slice(fill_first+key*fill_len,
+                                                       fill_first+(key+1)*fill_len)
+                self.line_slices[(layer, key)] = slice(line_first+key*line_len,
+                                                       line_first+(key+1)*line_len)
+
+        # positions and colours, written per shape by the key proxies
+        self.vertex_pos = np.zeros((self.num_vertices,2))
+        self.vertex_pix = np.zeros((self.num_vertices,2))
+        self.vertex_colors = np.ones((self.num_vertices,4))
+        for key, x in enumerate(xpos):
+            for layer, name in enumerate(self.LAYERS):
+                y = ypos-base_height if name == 'base_bottom' else ypos
+                self.set_shape_pos(layer, key, (x, y))
+                fill = np.array(color)
+                if name.endswith('bottom'):
+                    fill = fill+self.shadow_adjust_color
+                self.set_shape_colors(layer, key, fill, line_color)
+        self.pos_dirty = True
+
+        self.keys = [BatchedKeyDisplay(self, key) for key in range(n)]
+
+    def set_shape_pos(self, layer, key, pos):
+        self.vertex_pos[self.fill_slices[(layer, key)]] = pos
+        self.vertex_pos[self.line_slices[(layer, key)]] = pos
+        self.pos_dirty = True
+
+    def set_shape_colors(self, layer, key, fill_color=None, line_color=None):
+        # psychopy rgb [-1,1] -> GL rgb [0,1]
+        if fill_color is not None:
+            self.vertex_colors[self.fill_slices[(layer, key)],:3] = (np.array(fill_color)+1)/2
+        if line_color is not None:
+            self.vertex_colors[self.line_slices[(layer, key)],:3] = (np.array(line_color)+1)/2
+
+    def draw(self):
+        import pyglet.gl as GL
+        from psychopy.tools.monitorunittools import convertToPix
+        if self.pos_dirty:
+            self.vertex_pix[:] = convertToPix(self.local_vertices, self.vertex_pos,
+                                              self.win.units, self.win)
+            self.pos_dirty = False
+        GL.glPushMatrix()
+        # line smoothing and width are restored for the stims drawn after
+        GL.glPushAttrib(GL.GL_ENABLE_BIT | GL.GL_LINE_BIT)
+        self.win.setScale('pix')
+        GL.glEnable(GL.GL_LINE_SMOOTH)
+        GL.glLineWidth(self.line_width)
+        GL.glVertexPointer(2, GL.GL_DOUBLE, 0, self.vertex_pix.ctypes)
+        GL.glColorPointer(4, GL.GL_DOUBLE, 0, self.vertex_colors.ctypes)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+        for fill_first, fill_count, line_first, line_count in self.layer_ranges:
+            GL.glDrawArrays(GL.GL_TRIANGLES, fill_first, fill_count)
+            GL.glDrawArrays(GL.GL_LINES, line_first, line_count)
+        GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glPopAttrib()
+        GL.glPopMatrix()
+
+
+class BatchedKeyDisplay(ChangeTracker):
+    # KeyDisplay API backed by a slot in a KeyboardRenderer buffer; the
+    # renderer draws all keys, so draw() is a no-op here
+    def __init__(self, renderer, key):
+        ChangeTracker.__init__(self)
+        self.renderer = renderer
+        self.key = key
+        self.xpos = renderer.vertex_pos[renderer.fill_slices[(3, key)].start,0]
+
+    def setKeyColor(self, color):
+        self.set('key_color', color)
+
+    def setBaseColor(self, color):
+        self.set('base_color', color)
+
+    def setPos(self, ypos):
+        self.set('ypos', ypos)
+
+    def apply(self, name, value):
+        r = self.renderer
+        if name == 'key_color':
+            r.set_shape_colors(3, self.key, fill_color=value)
+            r.set_shape_colors(2, self.key, fill_color=np.array(value)+r.shadow_adjust_color)
+        elif name == 'base_color':
+            line_color = np.array(value)+r.line_adjust_color
+            r.set_shape_colors(1, self.key, fill_color=value, line_color=line_color)
+            r.set_shape_colors(0, self.key, fill_color=np.array(value)+r.shadow_adjust_color,
+                line_color=line_color)
+        elif name == 'ypos':
+            r.set_shape_pos(3, self.key, (self.xpos, value))
+
+    def draw(self):
+        pass
+
+
+class CueDisplay(ChangeTracker):
 
     def __init__(self, win, bg_color, cue_color, idle_color,
-                 success_color, fail_color):
+                 success_color, fail_color, images=None):
+        # images maps the png file names to preloaded images, if given
+        ChangeTracker.__init__(self)
         # graphics
         self.bg_color = bg_color
         self.cue_color = cue_color
         self.idle_color = idle_color
         self.success_color = success_color
         self.fail_color = fail_color
-        self.left_hand_light = visual.ImageStim(win,'hand-light.png',
+        if win is not None:
+            from psychopy.visual import ImageStim
+        else:
+            ImageStim = NullStim
+        if images is None:
+            images = {}
+        hand_light = images.get('hand-light.png', 'hand-light.png')
+        hand_dark = images.get('hand-dark.png', 'hand-dark.png')
+        self.left_hand_light = ImageStim(win,hand_light,
             size=(0.15,0.15),pos=(-0.3,0.25), interpolate=True)
-        self.left_hand_dark = visual.ImageStim(win,'hand-dark.png',
+        self.left_hand_dark = ImageStim(win,hand_dark,
             size=(0.15,0.15),pos=(-0.3,0.25), interpolate=False)
-        self.right_hand_light = visual.ImageStim(win,'hand-light.png',
+        self.right_hand_light = ImageStim(win,hand_light,
             size=(0.15,0.15),pos=(0.3,0.25), interpolate=True, flipHoriz=True)
-        self.right_hand_dark = visual.ImageStim(win,'hand-dark.png',
+        self.right_hand_dark = ImageStim(win,hand_dark,
             size=(0.15,0.15),pos=(0.3,0.25), interpolate=False, flipHoriz=True)
         self.cue_outline = gen_key_shape(win, width=0.3, height=0.03,
         corner_rad=0.04, line_width=5, corner_pts=5,
         fill_color=self.bg_color, line_color=self.cue_color,
         xpos=0, ypos=0.25)
-        self.cue_msg = visual.TextStim(win=win,
-            text='', pos=(0,0.25),
-            color=self.cue_color,
-            height=0.08)
-
         self.feedback_msgs = {'fast':'+3',
                               'success':'+1',
                               'fail':'+0'}
+        self.text_cache = TextCache(win, pos=(0,0.25), height=0.08)
+        self.text_cache.prepare(['', 'Press All'], self.cue_color)
+        self.text_cache.prepare(['+3', '+1'], self.success_color)
+        self.text_cache.prepare(['+0'], self.fail_color)
+        self.msg_text = ''
+        self.msg_color = self.cue_color
+        self.msg_key = self.text_cache.key(self.msg_text, self.msg_color)
+        self.cue_msg = self.text_cache.get(self.msg_text, self.msg_color)
 
         # logic
         self.active_hand = 'left' # 'left' or 'right'
@@ -112,63 +374,98 @@ class CueDisplay:
         # reset to start
         self.set_all_idle()
 
-    def draw(self):
-        if self.active_hand == 'left':
+    def draw(self, hand=None, cue_msg=None):
+        # hand and cue_msg default to the current ones (see ExoDisplay.display_state)
+        if hand is None:
+            hand = self.active_hand
+        if cue_msg is None:
+            cue_msg = self.cue_msg
+        if hand == 'left':
             self.left_hand_light.draw()
             self.right_hand_dark.draw()
-        elif self.active_hand == 'right':
+        elif hand == 'right':
             self.left_hand_dark.draw()
             self.right_hand_light.draw()
         else:
             self.left_hand_dark.draw()
             self.right_hand_dark.draw()
         self.cue_outline.draw()
-        self.cue_msg.draw()
+        cue_msg.draw()
+
+    def warm_up(self):
+        # draw every stim once so textures and shaders are built before run 1
+        for stim in [self.left_hand_light, self.left_hand_dark,
+                     self.right_hand_light, self.right_hand_dark, self.cue_outline]:
+            stim.draw()
+        self.text_cache.warm_up()
+
+    def set_outline_color(self, color):
+        self.set('outline_color', color)
+
+    def apply(self, name, value):
+        if name == 'outline_color':
+            self.cue_outline.lineColor = value
+
+    def prepare_cues(self, cues):
+        # prebuild the cue messages shown during trials
+        self.text_cache.prepare(cues, self.cue_color)
+
+    def set_message(self, text, color):
+        key = self.text_cache.key(text, color)
+        if key != self.msg_key:
+            self.msg_key = key
+            self.cue_msg = self.text_cache.get(text, color)
+            self.updates += 1
+        self.msg_text = text
+        self.msg_color = color
 
     def set_for_start(self, hand='left'):
-        self.cue_outline.lineColor = self.idle_color
-        self.cue_msg.text = 'Press All'
-        self.cue_msg.color = self.cue_color
+        self.set_outline_color(self.idle_color)
+        self.set_message('Press All', self.cue_color)
         self.active_hand = hand
 
     def set_all_idle(self):
-        self.cue_outline.lineColor = self.idle_color
-        self.cue_msg.text = ''
+        self.set_outline_color(self.idle_color)
+        self.set_message('', self.msg_color)
 
     def set_cue(self, seq='5 2 3 1 4'):
-        self.cue_outline.lineColor = self.cue_color
-        self.cue_msg.color = self.cue_color
-        self.cue_msg.text = seq
+        self.set_outline_color(self.cue_color)
+        self.set_message(seq, self.cue_color)
 
     def set_feedback(self, feedback):
-        self.cue_msg.text = self.feedback_msgs[feedback]
         if feedback == 'fast' or feedback == 'success':
-            self.cue_msg.color = self.success_color
-            self.cue_outline.lineColor = self.success_color
+            self.set_message(self.feedback_msgs[feedback], self.success_color)
+            self.set_outline_color(self.success_color)
         elif feedback == 'fail':
-            self.cue_msg.color = self.fail_color
-            self.cue_outline.lineColor = self.fail_color
+            self.set_message(self.feedback_msgs[feedback], self.fail_color)
+            self.set_outline_color(self.fail_color)
 
 class ExoDisplay:
 
-    def __init__(self, win, config):
+    def __init__(self, win, config, clock_factory=None, exo=None, images=None):
+        # win None runs headless: stims are replaced by NullStims; exo may be
+        # a connected Exoskeleton, or 'deferred' to attach one later
+        # with attach_exo (e.g. while it connects on another thread)
 
         # load config
         self.config = config
 
-        # load and start exo recording
-        if self.config['use_exo']:
-            self.exo_active = True
-            from exoskeleton import Exoskeleton
-            self.exo = Exoskeleton('output/passive', self.config['port'], 921600)
-            self.exo.read(duration=10000, log=False, display=False)
-        else:
-            self.exo_active = False
-
         # load hand/finger params
         self.num_fingers = self.config['num_fingers']
         self.num_active_fingers = self.config['num_active_fingers']
 
+        # clock for timestamping all input samples
+        self.Clock = clock_factory if clock_factory is not None else core.Clock
+        self.exo_clock = self.Clock()
+        self.sample_source = None # replaces the exo/keyboard input if set
+
+        # load and start exo recording
+        self.exo_active = False
+        if self.config['use_exo'] and exo != 'deferred':
+            if exo is None:
+                exo = connect_exo(self.config)
+            self.attach_exo(exo)
+
         # load display params
         self.key_width = self.config['key_width']
         self.key_height = self.config['key_height']
@@ -185,6 +482,24 @@ class ExoDisplay:
         self.display_angle_max = self.config['display_angle_max']
         self.valid_angle_min = self.config['valid_angle_min']
         self.valid_angle_max = self.config['valid_angle_max']
+        # keydown hysteresis; both default to display_angle_max (no hysteresis)
+        self.press_angle = self.config.get('press_angle', self.display_angle_max)
+        self.release_angle = self.config.get('release_angle', self.display_angle_max)
+        if self.release_angle > self.press_angle:
+            raise ValueError('release_angle should be <= press_angle')
+        # display-only prediction: keys are drawn predict_latency seconds
+        # ahead ('auto': sample age plus one frame period, up to predict_max)
+        # along the filter's derivative estimate; 0 turns it off
+        self.predict_latency = self.config.get('predict_latency', 0)
+        self.predict_max = self.config.get('predict_max', 0.05)
+        self.frame_period = win.monitorFramePeriod if win is not None else 1.0/60
+        self.ypos_scale = ((self.ypos_max-self.ypos_min)
+            /(self.display_angle_max-self.display_angle_min))
+
+        # physical finger indices shown on the keys for each hand
+        self.hand_fingers = {
+            'left': np.arange(self.num_active_fingers),
+            'right': np.arange(self.num_active_fingers, 2*self.num_active_fingers)}
 
         # set display
         self.key_color = self.config['key_color']
@@ -197,92 +512,262 @@ class ExoDisplay:
         self.cue_color = self.config['cue_color']
         self.xpos = np.arange(self.num_active_fingers)-(self.num_active_fingers-1)/2
         self.xpos = self.key_spacing*self.xpos
-        self.key_stims = [KeyDisplay(
+        self.key_template = KeyTemplate(
             key_width=self.key_width, key_height=self.key_height,
-            base_expand=self.key_base_expand, base_height=self.key_base_height,
-            corner_rad=self.key_corner_rad, line_width=self.key_line_width,
-            corner_pts=self.key_corner_pts, color=self.key_color,
+            base_expand=self.key_base_expand, corner_rad=self.key_corner_rad,
+            corner_pts=self.key_corner_pts)
+        key_params = dict(
+            xpos=self.xpos, ypos=self.base_ypos, base_height=self.key_base_height,
+            line_width=self.key_line_width, color=self.key_color,
             shadow_adjust_color=self.shadow_adjust_color,
             line_color=self.key_line_color,
-            line_adjust_color=self.line_adjust_color,
-            xpos=self.xpos[finger], ypos=self.base_ypos, win=win)
-                for finger in range(self.num_active_fingers)]
+            line_adjust_color=self.line_adjust_color, win=win)
+        if self.config.get('batch_keys', False) and win is not None:
+            # all keys drawn from one buffer
+            self.key_renderer = KeyboardRenderer(self.key_template, **key_params)
+            self.key_stims = self.key_renderer.keys
+        else:
+            self.key_renderer = None
+            self.key_stims = self.key_template.build_keys(**key_params)
         self.cue_display = CueDisplay(win,
             bg_color=self.config['bg_color'],cue_color=self.cue_color,
             idle_color=self.key_color, success_color=self.success_color,
-            fail_color=self.fail_color)
+            fail_color=self.fail_color, images=images)
 
         # data input and filtering
-        self.exo_clock = core.Clock()
         self.last_time = self.exo_clock.getTime()
         self.time_passed = 0
+        self.last_sample_time = None # exo_clock time of the last ingested sample
+        self.samples_ingested = 0 # samples filtered during the last update
         self.filter_bool = self.config['use_filter']
         self.angle_raw = np.zeros(self.num_fingers)
         self.angle_filt = np.zeros(self.num_fingers)
         self.spoof_keydowns = np.full(self.num_fingers, False)
+        self.spoof_events = [] # (exo_clock time, finger, down) not yet read
+        self.spoof_state = np.full(self.num_fingers, False) # as last read
+        self.spoof_press_times = np.full(self.num_fingers, np.nan)
         self.keydowns = np.full(self.num_fingers, False)
         self.new_keydowns = np.full(self.num_fingers, False)
+        self.keydown_times = np.full(self.num_fingers, np.nan) # exo_clock time
+        # (exo_clock time, key, down) of every press and release, in order
+        self.key_events = deque(maxlen=256)
+        self.key_ypos = np.zeros(self.num_active_fingers)
+        self.frame_updates = 0 # stim updates applied since the previous draw
         filter_config = {
             'freq': 120, # Hz, dummy value, will be updated with time_passed
             'mincutoff': self.config['filter_fc_min'], # Hz, minimum cutoff frequency
             'beta': self.config['filter_beta'], # arbitrary units, speed coefficient
             'dcutoff': self.config['filter_d_cutoff'] # Hz, derivative cutoff frequency
             }
-        self.filters = [OneEuroFilter(**filter_config) for filt in range(self.num_fingers)]
+        self.filter_bank = OneEuroFilterBank(self.num_fingers, **filter_config)
+
+    def attach_exo(self, exo):
+        # start exo recording, sampled into a ring buffer by a background
+        # thread so the render loop never touches the serial port
+        self.exo = exo
+        self.acquisition = ExoAcquisition(self.exo, self.num_fingers, self.exo_clock,
+            poll_rate=self.config.get('exo_poll_rate', 1000),
+            capacity=self.config.get('exo_buffer_size', 4096),
+            max_gap=self.config.get('exo_max_sample_gap', 0.01))
+        self.acquisition.start()
+        self.samples_read = 0 # ring buffer count at the last read
+        self.exo_active = True
 
     def toggle_filter(self):
         self.filter_bool = not(self.filter_bool)
 
+    def key_event(self, finger, down, event_time):
+        # keyboard press/release of a finger at its event time (exo_clock)
+        self.spoof_keydowns[finger] = down
+        self.spoof_events.append((event_time, finger, down))
+        if down:
+            self.spoof_press_times[finger] = event_time
+
+    def exo_time(self, core_time):
+        # psychopy/iohub global time to exo_clock time
+        return self.exo_clock.getTime()-(core.getTime()-core_time)
+
+    def read_samples(self):
+        # all samples received since the last frame, as a list of segments of
+        # timestamps (k,) in exo_clock time and angles (k, num_fingers)
+        if self.sample_source is not None:
+            return self.sample_source.read_samples(self)
+        if self.exo_active:
+            self.acquisition.check()
+            segments, self.samples_read = self.acquisition.buffer.since_count(self.samples_read)
+            return segments
+        # keyboard: one sample at each key event, then one at frame time
+        now = self.exo_clock.getTime()
+        times = []
+        states = []
+        state = self.spoof_state
+        for event_time, finger, down in self.spoof_events:
+            state = state.copy()
+            state[finger] = down
+            if event_time < now: # later events are covered by the frame sample
+                times.append(event_time)
+                states.append(state)
+        del self.spoof_events[:]
+        times.append(now)
+        states.append(self.spoof_keydowns.copy())
+        self.spoof_state = states[-1]
+        angles = np.where(states, 1.1*self.display_angle_max, self.display_angle_min)
+        return [(np.array(times), angles)]
+
+    def ingest_samples(self, times, angles):
+        # run every sample through validation, filtering and keydown
+        # detection in arrival order, so both see the true sample intervals
+        # rather than frame time
+        physical_fingers = self.hand_fingers[self.cue_display.active_hand]
+        for sample_time, sample in zip(times, angles):
+            prev_time = self.last_sample_time
+            prev_angles = self.angle_filt[physical_fingers]
+            # ignore inputs out of valid range, using previous value by default
+            valid = (sample >= self.valid_angle_min) & (sample <= self.valid_angle_max)
+            self.angle_raw[valid] = sample[valid]
+
+            if self.last_sample_time is None:
+                sample_passed = None
+            else:
+                sample_passed = sample_time-self.last_sample_time
+                if sample_passed <= 0:
+                    sample_passed = None # keep previous rate for repeated stamps
+            self.last_sample_time = sample_time
+
+            if self.filter_bool:
+                self.angle_filt[:] = self.filter_bank(self.angle_raw, sample_passed)
+            else:
+                self.angle_filt[:] = self.angle_raw
+            self.detect_keys(physical_fingers, prev_time, prev_angles, sample_time)
+        self.samples_ingested += len(times)
+
+    def detect_keys(self, physical_fingers, prev_time, prev_angles, sample_time):
+        # keydown hysteresis on one sample of the active fingers; each press
+        # or release is queued with the time the filtered angle crossed the
+        # threshold, interpolated between this sample and the previous one
+        angles = self.angle_filt[physical_fingers]
+        keydowns = self.keydowns[:self.num_active_fingers]
+        pressed = ~keydowns & (angles >= self.press_angle)
+        released = keydowns & (angles < self.release_angle)
+        if not(pressed.any() or released.any()):
+            return
+        events = []
+        for key in np.flatnonzero(pressed | released):
+            down = bool(pressed[key])
+            threshold = self.press_angle if down else self.release_angle
+            event_time = crossing_time(prev_time, prev_angles[key],
+                                       sample_time, angles[key], threshold)
+            if down and not(self.exo_active or self.sample_source is not None):
+                # keyboard presses keep their event time
+                press_time = self.spoof_press_times[physical_fingers[key]]
+                if not(np.isnan(press_time)) and press_time <= event_time:
+                    event_time = press_time
+            events.append((event_time, int(key), down))
+            keydowns[key] = down
+            if down:
+                self.new_keydowns[key] = True
+                self.keydown_times[key] = event_time
+        events.sort()
+        self.key_events.extend(events)
+
     def update_inputs(self):
         new_time = self.exo_clock.getTime()
         self.time_passed = new_time-self.last_time
         self.last_time = new_time
 
-        # update inputs (all fingers)
-        for finger in range(self.num_fingers):
-            if self.exo_active:
-                input_raw = exo.position[finger]
-            else:
-                if self.spoof_keydowns[finger]:
-                    input_raw = 1.1*self.display_angle_max
-                else:
-                    input_raw = self.display_angle_min
-
-            if (input_raw >= self.valid_angle_min) and (input_raw <= self.valid_angle_max):
-                self.angle_raw[finger] = input_raw
-            else:
-                pass # ignore input if out of valid range, using previous value by default
-
-            # # apply filtering
-            if self.filter_bool:
-                self.angle_filt[finger] = self.filters[finger](self.angle_raw[finger], self.time_passed)
-            else:
-                self.angle_filt[finger] = self.angle_raw[finger]
-
-        # update stims
-        for finger in range(self.num_active_fingers):
-            if self.cue_display.active_hand == 'left':
-                physical_finger = finger
-            elif self.cue_display.active_hand == 'right':
-                physical_finger = finger+self.num_active_fingers
-            self.key_stims[finger].setPos(
-                self.ypos_min+(self.ypos_max-self.ypos_min)
-                *(np.clip(self.display_angle_min,
-                         self.angle_filt[physical_finger],
-                         self.display_angle_max)
-                 - self.display_angle_min)
-                 /(self.display_angle_max-self.display_angle_min))
-
-            if self.angle_filt[physical_finger] >= self.display_angle_max:
-                if not(self.keydowns[finger]):
-                    self.new_keydowns[finger] = True
-                self.keydowns[finger] = True
-            elif self.angle_filt[physical_finger] < self.display_angle_max:
-                self.keydowns[finger] = False
+        # filter every sample since the last frame (all fingers per call) and
+        # queue its keydowns; only the final state drives the display
+        self.samples_ingested = 0
+        for times, angles in self.read_samples():
+            self.ingest_samples(times, angles)
+
+        # update stims (all active fingers at once)
+        physical_fingers = self.hand_fingers[self.cue_display.active_hand]
+        angles = self.angle_filt[physical_fingers]
+        if self.predict_latency and self.filter_bool:
+            angles = angles+self.display_latency()*self.filter_bank.dx_filt[physical_fingers]
+        self.key_ypos[:] = self.ypos_min+self.ypos_scale*(
+            np.clip(angles, self.display_angle_min, self.display_angle_max)
+            - self.display_angle_min)
+        for key_stim, ypos in zip(self.key_stims, self.key_ypos):
+            key_stim.setPos(ypos)
+
+    def display_latency(self):
+        # seconds from the latest sample to its appearance on screen
+        if self.predict_latency != 'auto':
+            return self.predict_latency
+        age = 0.0
+        if self.last_sample_time is not None:
+            age = max(self.exo_clock.getTime()-self.last_sample_time, 0.0)
+        return min(age+self.frame_period, self.predict_max)
+
+    def count_updates(self):
+        # real (changed) stim updates since the last call
+        updates = self.cue_display.updates
+        self.cue_display.updates = 0
+        for stim in self.key_stims:
+            updates += stim.updates
+            stim.updates = 0
+        return updates
+
+    def defer_stims(self):
+        # stim setters only record their values from now on; draw(state) with
+        # a display_state() copy applies them (see ChangeTracker)
+        for tracker in list(self.key_stims)+[self.cue_display]:
+            tracker.deferred = True
+
+    def display_state(self):
+        # everything draw() needs, copied so that it can be taken under a
+        # lock and drawn after releasing it
+        cue_display = self.cue_display
+        return {'updates': self.count_updates(),
+                'keys': [dict(stim.last_values) for stim in self.key_stims],
+                'cue': dict(cue_display.last_values),
+                'hand': cue_display.active_hand,
+                'cue_msg': cue_display.cue_msg}
+
+    def draw(self, state=None):
+        if state is None:
+            self.frame_updates = self.count_updates()
+            hand = cue_msg = None
+        else:
+            self.frame_updates = state['updates']
+            for stim, values in zip(self.key_stims, state['keys']):
+                stim.apply_values(values)
+            self.cue_display.apply_values(state['cue'])
+            hand = state['hand']
+            cue_msg = state['cue_msg']
+        if self.key_renderer is not None:
+            self.key_renderer.draw()
+        else:
+            for stim in self.key_stims: stim.draw()
+        self.cue_display.draw(hand, cue_msg)
 
-    def draw(self):
-        for stim in self.key_stims: stim.draw()
-        self.cue_display.draw()
+    def warm_up(self):
+        # draw all keys and cue stims once; the caller clears the back buffer
+        if self.key_renderer is not None:
+            self.key_renderer.draw()
+        else:
+            for stim in self.key_stims: stim.draw()
+        self.cue_display.warm_up()
+
+    def close(self):
+        if self.exo_active:
+            self.acquisition.stop()
+
+def crossing_time(t0, a0, t1, a1, threshold):
+    # time at which the line from (t0, a0) to (t1, a1) reaches threshold
+    if t0 is None or a1 == a0 or t1 <= t0:
+        return t1
+    frac = min(max((threshold-a0)/(a1-a0), 0.0), 1.0)
+    return t0+frac*(t1-t0)
+
+def connect_exo(config):
+    # open the exo port and start its stream
+    from exoskeleton import Exoskeleton
+    exo = Exoskeleton('output/passive', config['port'], 921600)
+    exo.read(duration=10000, log=False, display=False)
+    return exo
 
 # ----------------------------------------------------------------------------
 
@@ -323,6 +808,68 @@ class OneEuroFilter(object):
 
 # ----------------------------------------------------------------------------
 
+# same maths as OneEuroFilter/LowPassFilter, but with the state of every
+# channel held in arrays so all fingers are filtered in one call per sample
+
+def channel_param(value):
+    return float(value) if np.ndim(value) == 0 else np.array(value, dtype=float)
+
+class OneEuroFilterBank(object):
+
+    def __init__(self, num_channels, freq, mincutoff=1.0, beta=0.0, dcutoff=1.0):
+        # mincutoff, beta and dcutoff are scalars or one value per channel
+        if freq<=0:
+            raise ValueError("freq should be >0")
+        if np.any(np.asarray(mincutoff)<=0):
+            raise ValueError("mincutoff should be >0")
+        if np.any(np.asarray(dcutoff)<=0):
+            raise ValueError("dcutoff should be >0")
+        self.num_channels = int(num_channels)
+        self.freq = float(freq)
+        self.mincutoff = channel_param(mincutoff)
+        self.beta = channel_param(beta)
+        self.dcutoff = channel_param(dcutoff)
+        self.reset()
+
+    def reset(self):
+        self.x_prev = np.zeros(self.num_channels) # last raw value
+        self.x_filt = np.zeros(self.num_channels) # last filtered value
+        self.dx_filt = np.zeros(self.num_channels) # last filtered derivative
+        self.initialized = False
+
+    def alpha(self, cutoff):
+        te = 1.0 / self.freq
+        tau = 1.0 / (2*np.pi*cutoff)
+        return 1.0 / (1.0 + tau/te)
+
+    def __call__(self, x, time_passed=None):
+        x = np.asarray(x, dtype=float)
+        # ---- update the sampling frequency based on timestamps
+        if time_passed:
+            self.freq = 1.0 / float(time_passed)
+        if not(self.initialized):
+            # first sample passes through unfiltered, as in LowPassFilter
+            self.x_prev[:] = x
+            self.x_filt[:] = x
+            self.dx_filt[:] = 0.0
+            self.initialized = True
+            return self.x_filt.copy()
+        # ---- estimate the current variation per second
+        dx = (x-self.x_prev)*self.freq
+        a_d = self.alpha(self.dcutoff)
+        self.dx_filt *= (1.0-a_d)
+        self.dx_filt += a_d*dx
+        # ---- use it to update the cutoff frequency
+        cutoff = self.mincutoff + self.beta*np.abs(self.dx_filt)
+        # ---- filter the given value
+        a = self.alpha(cutoff)
+        self.x_filt *= (1.0-a)
+        self.x_filt += a*x
+        self.x_prev[:] = x
+        return self.x_filt.copy()
+
+# ----------------------------------------------------------------------------
+
 class LowPassFilter(object):
 
     def __init__(self, alpha):
@@ -0,0 +1,197 @@
+import os, sys, json, time, shutil, argparse, platform
+import numpy as np
+import yaml
+from ExoDisplay import (ExoDisplay, KeyDisplay, OneEuroFilter, OneEuroFilterBank,
+    LowPassFilter, gen_key_shape, key_shape_vertices)
+
+# hot-path benchmarks, runnable without a display; results are reported per
+# call and as a share of the frame budget at each refresh rate
+
+REFRESH_RATES = (60, 120, 144)
+
+def time_per_call(func, number=None, repeat=5, target_time=0.05):
+    # median seconds per call over repeat runs of number calls
+    if number is None:
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for i in range(number):
+                func()
+            if time.perf_counter()-start >= target_time or number >= 1<<20:
+                break
+            number *= 2
+    runs = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        runs.append((time.perf_counter()-start)/number)
+    return float(np.median(runs))
+
+def load_config(name):
+    with open(os.path.join('config', name+'.yml')) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+class RandomSource:
+    # samples_per_frame random angle samples per update_inputs call
+    def __init__(self, num_fingers, samples_per_frame, seed=0):
+        rng = np.random.default_rng(seed)
+        self.angles = rng.uniform(0, 40, size=(samples_per_frame, num_fingers))
+        self.times = np.arange(samples_per_frame)*1e-3
+        self.offset = 0.0
+
+    def read_samples(self, exo_display):
+        self.offset += 1.0
+        return [(self.times+self.offset, self.angles)]
+
+def bench_filters(results):
+    x = 12.3
+    one_euro = OneEuroFilter(freq=120, mincutoff=0.5, beta=0.25, dcutoff=1.0)
+    one_euro(x, 1/1000)
+    results['OneEuroFilter.__call__'] = time_per_call(lambda: one_euro(x, 1/1000))
+    low_pass = LowPassFilter(0.5)
+    low_pass(x)
+    results['LowPassFilter.__call__'] = time_per_call(lambda: low_pass(x, alpha=0.5))
+    for channels in (10, 20, 40):
+        bank = OneEuroFilterBank(channels, freq=120, mincutoff=0.5, beta=0.25, dcutoff=1.0)
+        xs = np.full(channels, x)
+        bank(xs, 1/1000)
+        results['OneEuroFilterBank.__call__[{}]'.format(channels)] = time_per_call(
+            lambda: bank(xs, 1/1000))
+
+def bench_update_inputs(results, config, win, samples_per_frame):
+    for channels in (10, 20, 40):
+        cfg = dict(config, use_exo=False, num_fingers=channels,
+                   num_active_fingers=channels//2)
+        exo_display = ExoDisplay(win, cfg)
+        exo_display.sample_source = RandomSource(channels, samples_per_frame)
+        results['ExoDisplay.update_inputs[{}]'.format(channels)] = time_per_call(
+            exo_display.update_inputs)
+        exo_display.close()
+
+def bench_shapes(results, config, win):
+    args = (config['key_width'], config['key_height'],
+            config['key_corner_rad'], config['key_corner_pts'])
+    results['key_shape_vertices (uncached)'] = time_per_call(
+        lambda: key_shape_vertices.__wrapped__(*args))
+    if win is None:
+        # without a window gen_key_shape and KeyDisplay build NullStims, so
+        # there is no ShapeStim construction to time
+        return
+    results['gen_key_shape'] = time_per_call(lambda: gen_key_shape(win,
+        width=args[0], height=args[1], corner_rad=args[2], corner_pts=args[3]))
+    results['KeyDisplay()'] = time_per_call(lambda: KeyDisplay(
+        key_width=config['key_width'], key_height=config['key_height'],
+        base_expand=config['key_base_expand'], base_height=config['key_base_height'],
+        corner_rad=config['key_corner_rad'], line_width=config['key_line_width'],
+        corner_pts=config['key_corner_pts'], color=config['key_color'],
+        shadow_adjust_color=config['shadow_adjust_color'],
+        line_color=config['key_line_color'],
+        line_adjust_color=config['line_adjust_color'],
+        xpos=0, ypos=0, win=win), repeat=3)
+
+class EventList:
+    # stands in for the iohub keyboard: returns the same events every call
+    def __init__(self, events):
+        self.events = events
+
+    def getKeys(self):
+        return self.events
+
+class KeyEvent:
+    def __init__(self, key, type, time=0.0):
+        self.key = key
+        self.type = type
+        self.time = time
+        self.modifiers = []
+
+def bench_game(results, config_name):
+    from replay import make_headless_game
+    subject = 'benchmark'
+    subject_path = os.path.join('logs', subject)
+    if os.path.exists(subject_path):
+        raise RuntimeError(subject_path+' already exists; the game benchmark writes '
+                           'its logs there and deletes them afterwards')
+    for frame_log in ('csv', 'binary', 'chunked'):
+        try:
+            game, time_source = make_headless_game(['-s', subject, '-c', config_name],
+                                                   {'frame_log': frame_log})
+            game.reset_for_exp()
+            game.seq_time = 0.5
+            game.add_score = 1
+            results['SequenceGame.write_frame[{}]'.format(frame_log)] = time_per_call(game.write_frame)
+            if frame_log == 'csv':
+                results['SequenceGame.write_trial'] = time_per_call(game.write_trial)
+
+                # one press and one release per call, as read from iohub
+                game.key_codes = ['q','w','e','r','v','n','u','i','o','p']
+                game.key_to_finger = {key:finger for finger, key in enumerate(game.key_codes)}
+                game.kb = EventList([KeyEvent('e', 'KEYBOARD_PRESS'),
+                                     KeyEvent('e', 'KEYBOARD_RELEASE')])
+                def check_keys():
+                    game.check_keys()
+                    del game.exo_display.spoof_events[:] # normally read each frame
+                results['SequenceGame.check_keys[2 events]'] = time_per_call(check_keys)
+            game.quit()
+        finally:
+            shutil.rmtree(subject_path, ignore_errors=True) # created by this run
+
+def report(results):
+    print('{:<40} {:>10} '.format('benchmark', 'us/call')
+          +' '.join('{:>8}'.format('%'+str(rate)+'Hz') for rate in REFRESH_RATES))
+    for name, seconds in results.items():
+        print('{:<40} {:10.2f} '.format(name, 1e6*seconds)
+              +' '.join('{:8.3f}'.format(100*seconds*rate) for rate in REFRESH_RATES))
+
+def compare(results, baseline_path, threshold):
+    # names whose time per call grew by more than threshold (e.g. 0.2 = 20%)
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > (1+threshold)*baseline[name]:
+            regressions.append(name)
+            print('REGRESSION {}: {:.2f} -> {:.2f} us'.format(
+                name, 1e6*baseline[name], 1e6*seconds))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hot-path benchmarks')
+    parser.add_argument('-c','--config', default='demo', help='Configuration file')
+    parser.add_argument('-o','--output', default=None, help='Write results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown vs baseline')
+    parser.add_argument('--samples-per-frame', type=int, default=16,
+                        help='Exo samples ingested per update_inputs call')
+    parser.add_argument('--window', action='store_true',
+                        help='Build stims in a real window instead of headless')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    win = None
+    if args.window:
+        from psychopy import visual
+        win = visual.Window(size=(config['screen_width'], config['screen_height']),
+                            color=config['bg_color'], units='height')
+
+    results = {}
+    bench_filters(results)
+    bench_update_inputs(results, config, win, args.samples_per_frame)
+    bench_shapes(results, config, win)
+    bench_game(results, args.config)
+    report(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'python': platform.python_version(),
+                                'numpy': np.__version__,
+                                'machine': platform.node(),
+                                'config': args.config,
+                                'window': args.window,
+                                'samples_per_frame': args.samples_per_frame},
+                       'refresh_rates': REFRESH_RATES,
+                       'results': results}, f, indent=1)
+    if args.compare is not None:
+        if compare(results, args.compare, args.threshold):
+            sys.exit(1)
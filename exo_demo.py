@@ -2,6 +2,7 @@ from psychopy import core, event, visual
 import numpy as np
 import yaml
 from ExoDisplay import ExoDisplay
+from frame_profiler import make_profiler
 
 class ExoDemoGame:
 
@@ -29,6 +30,7 @@ class ExoDemoGame:
             self.io = launchHubServer()
             self.kb = self.io.devices.keyboard
             self.key_codes = ['a','w','e','r','b']
+            self.key_to_finger = {key:finger for finger, key in enumerate(self.key_codes)}
 
         # rough SRT demo
         self.exp_running = False
@@ -38,6 +40,10 @@ class ExoDemoGame:
         self.target_finger = 0
         self.finger_pressed = False
 
+        # per-frame phase timing, summary printed at quit
+        self.profiler = make_profiler(self.config, self.win,
+            ['check_keys', 'update_inputs', 'logic', 'draw', 'flip'])
+
     def toggle_exp(self):
         self.exp_running = not(self.exp_running)
         self.reset_trial()
@@ -68,27 +74,36 @@ class ExoDemoGame:
     def check_keys(self):
         events = self.kb.getKeys()
         for kbe in events:
-            if kbe.key in self.key_codes:
+            finger = self.key_to_finger.get(kbe.key)
+            if finger is not None:
                 if kbe.type == 'KEYBOARD_PRESS':
-                    self.exo_display.spoof_keydowns[int(np.where(kbe.key==np.array(self.key_codes))[0])]=True
+                    self.exo_display.key_event(finger, True, self.exo_display.exo_time(kbe.time))
                 elif kbe.type == 'KEYBOARD_RELEASE':
-                    self.exo_display.spoof_keydowns[int(np.where(kbe.key==np.array(self.key_codes))[0])]=False
+                    self.exo_display.key_event(finger, False, self.exo_display.exo_time(kbe.time))
             elif (kbe.key == 'q') and (len(kbe.modifiers)==1):
                 if kbe.modifiers[0]=='lctrl': self.quit()
 
     def run_main_loop(self):
+        profiler = self.profiler
         while True:
+            profiler.start_frame()
             if not(self.exo_display.exo_active):
                 self.check_keys()
+            profiler.mark(0)
             self.exo_display.update_inputs()
+            profiler.mark(1)
             if self.exp_running:
                 self.run_trial()
+            profiler.mark(2)
             self.exo_display.draw()
-            self.win.flip()
+            profiler.mark(3)
+            flip_time = self.win.flip()
+            profiler.mark(4)
+            profiler.end_frame(flip_time, updates=self.exo_display.frame_updates)
 
     def quit(self):
-        if self.exo_display.exo_active:
-            self.exo_display.exo.stop()
+        self.profiler.close()
+        self.exo_display.close()
         core.quit()
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+import threading, time
+import numpy as np
+
+def run_at_rate(rate, step, stop):
+    # step() every 1/rate s until stop() is true, on a fixed tick grid so a
+    # late tick does not shift the next ones; a tick up to one period late
+    # is caught up, beyond that the missed ticks are skipped, not burst
+    period = 1.0/rate
+    next_tick = time.perf_counter()
+    while not(stop()):
+        step()
+        next_tick += period
+        delay = next_tick-time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -period:
+            next_tick = time.perf_counter()
+
+class SampleRingBuffer:
+
+    def __init__(self, capacity, num_channels):
+        # preallocated storage, written by one producer thread
+        self.capacity = int(capacity)
+        self.num_channels = int(num_channels)
+        self.times = np.zeros(self.capacity)
+        self.angles = np.zeros((self.capacity, self.num_channels))
+        self.count = 0 # total samples ever pushed
+
+    def push(self, sample_time, angles):
+        idx = self.count % self.capacity
+        self.times[idx] = sample_time
+        self.angles[idx,:] = angles
+        self.count += 1 # publish only once the record is complete
+
+    def latest(self):
+        # (time, angles copy) of the newest sample, or (None, None) if empty
+        segments = self.segments(self.count-1, self.count)
+        if len(segments) == 0:
+            return None, None
+        times, angles = segments[0]
+        return times[0], angles[0]
+
+    def segments(self, start, stop):
+        # copies of sample numbers [start, stop), split at the wrap point.
+        # There is no lock: the producer may overwrite the oldest slots while
+        # they are copied, so after copying, the samples that count says were
+        # written over in the meantime are dropped
+        start = max(start, stop-self.capacity+1, 0)
+        if start >= stop:
+            return []
+        i0 = start % self.capacity
+        i1 = i0 + (stop-start)
+        if i1 <= self.capacity:
+            segments = [(self.times[i0:i1].copy(), self.angles[i0:i1].copy())]
+        else:
+            i1 -= self.capacity
+            segments = [(self.times[i0:].copy(), self.angles[i0:].copy()),
+                        (self.times[:i1].copy(), self.angles[:i1].copy())]
+        overwritten = self.count-self.capacity+1-start # slot count-capacity is being written
+        while overwritten > 0 and segments:
+            times, angles = segments[0]
+            if overwritten >= len(times):
+                overwritten -= len(times)
+                segments.pop(0)
+            else:
+                segments[0] = (times[overwritten:], angles[overwritten:])
+                overwritten = 0
+        return segments
+
+    def since_count(self, start):
+        # copies of every sample pushed since sample number start, plus the
+        # count to pass in on the next call
+        stop = self.count
+        return self.segments(start, stop), stop
+
+    def since(self, t):
+        # copies of every sample with a timestamp after t
+        stop = self.count
+        segments = []
+        for times, angles in self.segments(0, stop):
+            first = np.searchsorted(times, t, side='right')
+            if first < len(times):
+                segments.append((times[first:], angles[first:]))
+        return segments
+
+
+class ExoAcquisition:
+
+    def __init__(self, exo, num_channels, clock, poll_rate=1000, capacity=4096,
+                 max_gap=0.01):
+        # exo is any device exposing a position sequence and stop(), read in
+        # the background by its own driver; this worker polls position at
+        # poll_rate and timestamps and keeps each new sample in a ring buffer
+        self.exo = exo
+        self.num_channels = num_channels
+        self.clock = clock
+        self.poll_rate = poll_rate
+        self.max_gap = max_gap
+        self.buffer = SampleRingBuffer(capacity, num_channels)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='exo-acquisition',
+                                       daemon=True)
+        self.error = None
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        # runs on the acquisition thread, which alone owns the poll state.
+        # A reading is a new sample when the driver has published a new
+        # position sequence (one per packet) or its values changed; a
+        # position updated in place that holds exactly still (quantized
+        # readings at rest) is still pushed every max_gap seconds, so the
+        # filter never sees repeats at the poll rate nor long gaps
+        last_position = None
+        last_angles = None
+        last_time = None
+
+        def poll():
+            nonlocal last_position, last_angles, last_time
+            position = self.exo.position
+            now = self.clock.getTime()
+            angles = np.array(position[:self.num_channels], dtype=float)
+            if (position is last_position and np.array_equal(angles, last_angles)
+                    and now-last_time < self.max_gap):
+                return
+            self.buffer.push(now, angles)
+            last_position = position
+            last_angles = angles
+            last_time = now
+
+        try:
+            run_at_rate(self.poll_rate, poll, self.stop_event.is_set)
+        except Exception as e:
+            self.error = e # surfaced to the render loop via check()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError('exo acquisition stopped: '+repr(self.error))
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+        self.exo.stop()
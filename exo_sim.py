@@ -0,0 +1,151 @@
+import os, sys, time, struct, argparse, signal
+import numpy as np
+
+# simulated exoskeleton on a pseudo-terminal: a generator writes multi-finger
+# angle frames to the master side at the device sample rate, and the slave
+# side is opened like the real serial port (set `port:` to the printed path)
+
+BAUD = 921600
+
+def encode_csv(angles):
+    # one text line per sample: comma-separated angles in degrees
+    return (','.join(['{:.2f}'.format(a) for a in angles])+'\n').encode('ascii')
+
+BINARY_SYNC = b'\xaa\x55'
+
+def encode_binary(angles):
+    # sync word followed by little-endian float32 angles
+    return BINARY_SYNC+struct.pack('<{}f'.format(len(angles)), *angles)
+
+FRAMINGS = {'csv': encode_csv, 'binary': encode_binary}
+
+class AngleGenerator:
+    # finger flexion traces: raised-cosine presses from a resting angle, with
+    # gaussian noise, dropped samples and out-of-range spikes
+
+    def __init__(self, num_fingers=10, sample_rate=1000, rest_angle=2.0,
+                 press_angle=40.0, press_rate=3.0, press_duration=(0.08, 0.2),
+                 noise=0.3, dropout=0.0, dropout_length=20, spike=0.0,
+                 spike_angle=250.0, seed=0):
+        self.num_fingers = num_fingers
+        self.sample_period = 1.0/sample_rate
+        self.rest_angle = rest_angle
+        self.press_angle = press_angle
+        self.press_rate = press_rate # presses per second, all fingers
+        self.press_duration = press_duration
+        self.noise = noise
+        self.dropout = dropout # probability a dropout starts at a sample
+        self.dropout_length = dropout_length # samples lost per dropout
+        self.spike = spike # probability of an out-of-range value per sample
+        self.spike_angle = spike_angle
+        self.rng = np.random.default_rng(seed)
+        self.presses = [] # (finger, start, duration)
+        self.next_press = self.rng.exponential(1.0/press_rate)
+        self.dropout_left = 0
+        self.t = 0.0
+
+    def sample(self):
+        # next sample as (time, angles), or (time, None) while dropped out
+        self.t += self.sample_period
+        t = self.t
+        while t >= self.next_press:
+            self.presses.append((self.rng.integers(self.num_fingers), self.next_press,
+                                 self.rng.uniform(*self.press_duration)))
+            self.next_press += self.rng.exponential(1.0/self.press_rate)
+        self.presses = [p for p in self.presses if t < p[1]+p[2]]
+        angles = np.full(self.num_fingers, self.rest_angle)
+        for finger, start, duration in self.presses:
+            phase = (t-start)/duration
+            if 0 <= phase < 1:
+                angles[finger] += 0.5*(1-np.cos(2*np.pi*phase))*(self.press_angle-self.rest_angle)
+        angles += self.rng.normal(0, self.noise, self.num_fingers)
+        if self.spike > 0:
+            spikes = self.rng.random(self.num_fingers) < self.spike
+            angles[spikes] = self.spike_angle*self.rng.choice([-1, 1], size=spikes.sum())
+        if self.dropout_left > 0:
+            self.dropout_left -= 1
+            return t, None
+        if self.rng.random() < self.dropout:
+            self.dropout_left = self.dropout_length-1
+            return t, None
+        return t, angles
+
+def open_pty(link=None):
+    import pty, tty, termios
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    attrs = termios.tcgetattr(slave)
+    speed = getattr(termios, 'B'+str(BAUD), None)
+    if speed is not None:
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    path = os.ttyname(slave)
+    if link is not None:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(path, link)
+    return master, slave, path
+
+def run_device(master, generator, encode, seconds=None, max_batch=64):
+    # write samples at the generator's rate, paced against the wall clock;
+    # if the reader stalls, samples queue up like in the device's buffer
+    start = time.perf_counter()
+    sent = 0
+    written = 0
+    while seconds is None or generator.t < seconds:
+        due = time.perf_counter()-start
+        frames = []
+        while generator.t+generator.sample_period <= due and len(frames) < max_batch:
+            t, angles = generator.sample()
+            if angles is not None:
+                frames.append(encode(angles))
+        if frames:
+            data = b''.join(frames)
+            os.write(master, data)
+            sent += len(frames)
+            written += len(data)
+        else:
+            time.sleep(generator.sample_period/2)
+    return sent, written
+
+def max_sample_rate(encode, num_fingers):
+    # samples per second the serial link can carry (10 bits per byte)
+    return BAUD/10.0/len(encode(np.zeros(num_fingers)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated exoskeleton serial device')
+    parser.add_argument('--fingers', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=1000, help='Samples per second')
+    parser.add_argument('--framing', choices=sorted(FRAMINGS), default='csv')
+    parser.add_argument('--press-rate', type=float, default=3.0, help='Presses per second')
+    parser.add_argument('--noise', type=float, default=0.3, help='Noise SD (degrees)')
+    parser.add_argument('--dropout', type=float, default=0.0, help='Dropout probability per sample')
+    parser.add_argument('--dropout-length', type=int, default=20, help='Samples lost per dropout')
+    parser.add_argument('--spike', type=float, default=0.0, help='Out-of-range spike probability per value')
+    parser.add_argument('--seconds', type=float, default=None, help='Stop after this long')
+    parser.add_argument('--link', default=None, help='Symlink to the device path, e.g. /tmp/exo-sim')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    encode = FRAMINGS[args.framing]
+    limit = max_sample_rate(encode, args.fingers)
+    if args.rate > limit:
+        print('warning: {:.0f} Hz exceeds what {} baud carries ({:.0f} Hz)'.format(
+            args.rate, BAUD, limit))
+    generator = AngleGenerator(num_fingers=args.fingers, sample_rate=args.rate,
+        press_rate=args.press_rate, noise=args.noise, dropout=args.dropout,
+        dropout_length=args.dropout_length, spike=args.spike, seed=args.seed)
+    master, slave, path = open_pty(args.link)
+    print('simulated exo on', path if args.link is None else args.link+' -> '+path)
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        sent, written = run_device(master, generator, encode, args.seconds)
+        print('sent {} samples ({} bytes)'.format(sent, written))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link is not None and os.path.lexists(args.link):
+            os.remove(args.link)
+        os.close(master)
+        os.close(slave)
@@ -0,0 +1,168 @@
+import os, time, argparse, itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import yaml
+from ExoDisplay import OneEuroFilterBank
+from log_loader import load_csv
+from frame_log import read_frame_log
+
+# offline One Euro parameter sweep: every (filter_fc_min, filter_beta,
+# filter_d_cutoff) combination filters the recorded angles in one bank,
+# vectorized over parameter sets and fingers; large grids are split over a
+# process pool. Angles should be unfiltered, i.e. recorded with
+# use_filter: False (or from the exo simulator)
+
+SCORE_FIELDS = ['jitter', 'lag', 'spurious', 'missed']
+
+def load_streams(subject_path):
+    # per sequence execution: (times, angles) from frame.csv, frame.bin or frame.chunks
+    csv_path = os.path.join(subject_path, 'frame.csv')
+    if os.path.exists(csv_path):
+        data = load_csv(csv_path)
+        finger_names = [name for name in data.dtype.names if name.startswith('f_')]
+        angles = np.column_stack([data[name] for name in finger_names])
+        times = np.asarray(data['trial_time'])
+        trials = np.asarray(data['trial'])
+    else:
+        data, meta = read_frame_log(subject_path)
+        angles = data['angles']
+        times = data['trial_time']
+        trials = data['trial']
+    # split where the execution changes or the trial clock restarts
+    breaks = np.flatnonzero((trials[1:] != trials[:-1]) | (times[1:] <= times[:-1]))+1
+    bounds = np.concatenate([[0], breaks, [len(times)]])
+    return [(times[start:stop], angles[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:]) if stop-start > 2]
+
+def keydown_count(angles, press_angle, release_angle):
+    # presses per channel of an (n, channels) trace, with hysteresis
+    down = np.full(angles.shape[1], False)
+    count = np.zeros(angles.shape[1], dtype=int)
+    for sample in angles:
+        pressed = ~down & (sample >= press_angle)
+        count += pressed
+        down |= pressed
+        down &= ~(sample < release_angle)
+    return count
+
+def score_grid(streams, grid, press_angle, release_angle, ref_band):
+    # scores (len(grid), 4) summed over fingers and streams:
+    #   jitter   RMS second difference of the filtered angle (degrees)
+    #   lag      least-squares delay of filtered vs raw, filt(t) ~ raw(t-lag) (s)
+    #   spurious keydowns of the filtered angle beyond those of the raw
+    #            angle with a ref_band hysteresis band (chatter-free reference)
+    #   missed   reference keydowns the filtered angle does not reach
+    num_params = len(grid)
+    jitter_sq = np.zeros(num_params)
+    jitter_n = 0
+    lag_num = np.zeros(num_params)
+    lag_den = np.zeros(num_params)
+    spurious = np.zeros(num_params)
+    missed = np.zeros(num_params)
+    for times, angles in streams:
+        num_fingers = angles.shape[1]
+        bank = OneEuroFilterBank(num_params*num_fingers, freq=120,
+            mincutoff=np.repeat(grid[:,0], num_fingers),
+            beta=np.repeat(grid[:,1], num_fingers),
+            dcutoff=np.repeat(grid[:,2], num_fingers))
+        filtered = np.empty((len(times), num_params, num_fingers))
+        prev_time = None
+        for i, (sample_time, sample) in enumerate(zip(times, angles)):
+            time_passed = None if prev_time is None else sample_time-prev_time
+            prev_time = sample_time
+            filtered[i] = bank(np.tile(sample, num_params), time_passed).reshape(
+                num_params, num_fingers)
+
+        # jitter
+        accel = filtered[2:]-2*filtered[1:-1]+filtered[:-2]
+        jitter_sq += np.sum(accel**2, axis=(0, 2))
+        jitter_n += accel.shape[0]*num_fingers
+
+        # lag, from the raw derivative
+        velocity = np.diff(angles, axis=0)/np.diff(times)[:,np.newaxis]
+        error = angles[1:,np.newaxis,:]-filtered[1:]
+        lag_num += np.sum(error*velocity[:,np.newaxis,:], axis=(0, 2))
+        lag_den += np.sum(velocity**2)
+
+        # keydowns
+        reference = keydown_count(angles, press_angle, press_angle-ref_band)
+        counts = keydown_count(filtered.reshape(len(times), -1),
+            press_angle, release_angle).reshape(num_params, num_fingers)
+        spurious += np.sum(np.maximum(counts-reference, 0), axis=1)
+        missed += np.sum(np.maximum(reference-counts, 0), axis=1)
+
+    scores = np.zeros((num_params, len(SCORE_FIELDS)))
+    scores[:,0] = np.sqrt(jitter_sq/max(jitter_n, 1))
+    scores[:,1] = lag_num/np.where(lag_den > 0, lag_den, 1)
+    scores[:,2] = spurious
+    scores[:,3] = missed
+    return scores
+
+def sweep(subject_paths, grid, press_angle, release_angle, ref_band=5.0,
+          processes=None, chunk_size=256):
+    # scores for every grid row, computed chunk_size parameter sets at a time;
+    # the sessions are loaded once here (building any csv sidecars) and the
+    # streams handed to the workers
+    streams = []
+    for subject_path in subject_paths:
+        streams.extend(load_streams(subject_path))
+    streams = [(np.array(times), np.array(angles)) for times, angles in streams]
+    chunks = [grid[start:start+chunk_size] for start in range(0, len(grid), chunk_size)]
+    args = (press_angle, release_angle, ref_band)
+    if processes == 1 or len(chunks) == 1:
+        results = [score_grid(streams, chunk, *args) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(score_grid, itertools.repeat(streams),
+                                    chunks, *[itertools.repeat(arg) for arg in args]))
+    return np.concatenate(results)
+
+def parse_values(text):
+    # '0.5,1,2' or 'start:stop:num' (geometric spacing)
+    if ':' in text:
+        start, stop, num = text.split(':')
+        return np.geomspace(float(start), float(stop), int(num))
+    return np.array([float(value) for value in text.split(',')])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline One Euro filter parameter sweep')
+    parser.add_argument('sessions', nargs='+', help='Session folders, e.g. logs/<subjectid>')
+    parser.add_argument('-c','--config', default='demo', help='Configuration file (keydown angles)')
+    parser.add_argument('--fc-min', default='0.1:5:12', help='filter_fc_min values')
+    parser.add_argument('--beta', default='0.01:2:12', help='filter_beta values')
+    parser.add_argument('--d-cutoff', default='0.5,1,2', help='filter_d_cutoff values')
+    parser.add_argument('--ref-band', type=float, default=5.0,
+                        help='Hysteresis of the raw reference keydowns (degrees)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk', type=int, default=256, help='Parameter sets per task')
+    parser.add_argument('--top', type=int, default=10, help='Rows to print')
+    parser.add_argument('-o','--output', default='filter_sweep.csv')
+    args = parser.parse_args()
+
+    with open(os.path.join('config', args.config+'.yml')) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    press_angle = config.get('press_angle', config['display_angle_max'])
+    release_angle = config.get('release_angle', config['display_angle_max'])
+    grid = np.array(list(itertools.product(parse_values(args.fc_min),
+        parse_values(args.beta), parse_values(args.d_cutoff))))
+
+    start = time.perf_counter()
+    scores = sweep(args.sessions, grid, press_angle, release_angle,
+                   args.ref_band, args.processes, args.chunk)
+    print('{} parameter sets x {} sessions in {:.1f} s'.format(
+        len(grid), len(args.sessions), time.perf_counter()-start))
+
+    with open(args.output, 'w') as f:
+        f.write('filter_fc_min,filter_beta,filter_d_cutoff,'+','.join(SCORE_FIELDS)+'\n')
+        for params, row in zip(grid, scores):
+            f.write(','.join(['{:.6g}'.format(value) for value in params]+
+                             ['{:.6g}'.format(value) for value in row])+'\n')
+
+    # fewest keydown errors first, then least lag, then least jitter
+    order = np.lexsort((scores[:,0], scores[:,1], scores[:,2]+scores[:,3]))
+    print('{:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>7}'.format(
+        'fc_min', 'beta', 'd_cutoff', 'jitter', 'lag_ms', 'spurious', 'missed'))
+    for i in order[:args.top]:
+        print('{:10.3g} {:10.3g} {:10.3g} {:10.4f} {:10.1f} {:9.0f} {:7.0f}'.format(
+            grid[i,0], grid[i,1], grid[i,2], scores[i,0], 1e3*scores[i,1],
+            scores[i,2], scores[i,3]))
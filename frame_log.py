@@ -0,0 +1,374 @@
+import os, sys, json, zlib, queue, struct, threading
+import numpy as np
+
+def frame_dtype(num_fingers):
+    # one fixed-layout record per frame; hand and seq_id are stored as codes
+    return np.dtype([('trial_time', 'f8'),
+                     ('angles', 'f8', (num_fingers,)),
+                     ('hand', 'u1'),
+                     ('seq_id', 'u1'),
+                     ('trial', 'i4'), # sequence execution number, as in frame.csv
+                     ('run', 'i4')])
+
+class BinaryFrameSink:
+    # raw records in frame.bin, with the layout and code tables in frame.json;
+    # resume_bytes appends to an existing frame.bin cut back to that size
+
+    def __init__(self, subject_path, meta, resume_bytes=None):
+        self.bin_path = os.path.join(subject_path, 'frame.bin')
+        with open(os.path.join(subject_path, 'frame.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        if resume_bytes is None:
+            self.file = open(self.bin_path, 'wb')
+        else:
+            from schedule import truncate_log
+            truncate_log(self.bin_path, resume_bytes)
+            self.file = open(self.bin_path, 'ab')
+
+    def write(self, records):
+        self.file.write(records.tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# frame.chunks: a run of chunks, each a CHUNK_HEADER and its zlib payload,
+# then (once closed) the chunk index and a TRAILER pointing at it
+CHUNK_TAG = b'FCHK'
+INDEX_TAG = b'FIDX'
+END_TAG = b'FEND'
+# tag, payload bytes, records, run, trial, execution, first and last trial_time
+CHUNK_HEADER = struct.Struct('<4sIIiiidd')
+TRAILER = struct.Struct('<QQ4s') # index offset, number of chunks, END_TAG
+
+chunk_index_dtype = np.dtype([('run', 'i4'),
+                              ('trial', 'i4'), # trial within the run, -1 if unknown
+                              ('execution', 'i4'),
+                              ('offset', 'i8'),
+                              ('size', 'i8'), # header and payload bytes
+                              ('num_records', 'i4'),
+                              ('start_time', 'f8'),
+                              ('end_time', 'f8')])
+
+def delta(values):
+    # along the records; integer overflow wraps, and cumsum undoes it
+    values = np.ascontiguousarray(values)
+    out = values.copy()
+    out[1:] -= values[:-1]
+    return out
+
+def encode_chunk(records, level=6):
+    # the columns one after another: trial_time as float64 and angles as
+    # float32 (finger by finger), both delta-encoded on their integer bit
+    # patterns so slowly changing values become small, repetitive integers
+    times = np.ascontiguousarray(records['trial_time']).view(np.int64)
+    angles = np.ascontiguousarray(records['angles'], dtype=np.float32).view(np.int32)
+    columns = [delta(times), delta(angles).T, records['hand'], records['seq_id'],
+               records['trial'], records['run']]
+    return zlib.compress(b''.join([np.ascontiguousarray(column).tobytes()
+                                   for column in columns]), level)
+
+def decode_chunk(payload, num_records, num_fingers):
+    data = zlib.decompress(payload)
+    records = np.zeros(num_records, dtype=frame_dtype(num_fingers))
+    offset = 0
+    def column(dtype, count):
+        nonlocal offset
+        values = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        offset += values.nbytes
+        return values
+    times = np.cumsum(column(np.int64, num_records), dtype=np.int64)
+    records['trial_time'] = times.view(np.float64)
+    angles = column(np.int32, num_records*num_fingers).reshape(num_fingers, num_records).T
+    records['angles'] = np.cumsum(angles, axis=0, dtype=np.int32).view(np.float32)
+    for name in ['hand', 'seq_id', 'trial', 'run']:
+        records[name] = column(records.dtype[name], num_records)
+    return records
+
+def scan_chunks(f, size):
+    # index rebuilt from the chunk headers, for a file that was never closed;
+    # stops at the footer or at a chunk cut short by a crash
+    index = []
+    offset = 0
+    while offset+CHUNK_HEADER.size <= size:
+        f.seek(offset)
+        (tag, payload_bytes, num_records, run, trial, execution,
+         start_time, end_time) = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+        chunk_bytes = CHUNK_HEADER.size+payload_bytes
+        if tag != CHUNK_TAG or offset+chunk_bytes > size:
+            break
+        index.append((run, trial, execution, offset, chunk_bytes, num_records,
+                      start_time, end_time))
+        offset += chunk_bytes
+    return np.array(index, dtype=chunk_index_dtype), offset
+
+def read_chunk_index(f):
+    # (index, end of the chunk data) from the footer, or from the headers
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size >= TRAILER.size:
+        f.seek(size-TRAILER.size)
+        index_offset, num_chunks, tag = TRAILER.unpack(f.read(TRAILER.size))
+        index_bytes = num_chunks*chunk_index_dtype.itemsize
+        if tag == END_TAG and index_offset+len(INDEX_TAG)+index_bytes+TRAILER.size == size:
+            f.seek(index_offset)
+            if f.read(len(INDEX_TAG)) == INDEX_TAG:
+                index = np.frombuffer(f.read(index_bytes), dtype=chunk_index_dtype)
+                return index.copy(), index_offset
+    return scan_chunks(f, size)
+
+class ChunkedFrameSink:
+    # compressed chunks of at most chunk_size records in frame.chunks, each
+    # from a single sequence execution, so one trial is one contiguous read;
+    # the layout and code tables go to frame.json as for frame.bin.
+    # execution_trials maps execution numbers to the trial within the run
+    # for the index. resume_records keeps the chunks holding the first
+    # resume_records records of an existing frame.chunks and appends to them
+
+    def __init__(self, subject_path, meta, chunk_size=1024, execution_trials=None,
+                 resume_records=None, level=6):
+        self.path = os.path.join(subject_path, 'frame.chunks')
+        meta = dict(meta, storage='chunked', chunk_size=chunk_size)
+        with open(os.path.join(subject_path, 'frame.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        self.execution_trials = execution_trials
+        self.level = level
+        self.pending = np.zeros(chunk_size, dtype=frame_dtype(meta['num_fingers']))
+        self.num_pending = 0
+        self.index = []
+        if resume_records is None:
+            self.file = open(self.path, 'wb')
+        else:
+            from schedule import truncate_log
+            with open(self.path, 'rb') as f:
+                index, end = read_chunk_index(f)
+            index = index[np.cumsum(index['num_records']) <= resume_records]
+            end = int(index['offset'][-1]+index['size'][-1]) if len(index) > 0 else 0
+            truncate_log(self.path, end)
+            self.index = [tuple(row) for row in index.tolist()]
+            self.file = open(self.path, 'ab')
+
+    def trial_of(self, execution):
+        if self.execution_trials is None or not(0 <= execution < len(self.execution_trials)):
+            return -1
+        return int(self.execution_trials[execution])
+
+    def write(self, records):
+        # split at execution (or run) changes, topping up the pending chunk
+        if len(records) == 0:
+            return
+        trials = records['trial']
+        runs = records['run']
+        change = np.flatnonzero((trials[1:] != trials[:-1]) | (runs[1:] != runs[:-1]))+1
+        bounds = np.concatenate([[0], change, [len(records)]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if self.num_pending > 0 and (self.pending['trial'][0] != trials[start]
+                                         or self.pending['run'][0] != runs[start]):
+                self.write_chunk()
+            while start < stop:
+                count = min(stop-start, len(self.pending)-self.num_pending)
+                self.pending[self.num_pending:self.num_pending+count] = records[start:start+count]
+                self.num_pending += count
+                start += count
+                if self.num_pending == len(self.pending):
+                    self.write_chunk()
+
+    def write_chunk(self):
+        records = self.pending[:self.num_pending]
+        payload = encode_chunk(records, self.level)
+        run = int(records['run'][0])
+        execution = int(records['trial'][0])
+        trial = self.trial_of(execution)
+        start_time = float(records['trial_time'][0])
+        end_time = float(records['trial_time'][-1])
+        offset = self.file.tell()
+        self.file.write(CHUNK_HEADER.pack(CHUNK_TAG, len(payload), len(records), run,
+                                          trial, execution, start_time, end_time))
+        self.file.write(payload)
+        self.index.append((run, trial, execution, offset, CHUNK_HEADER.size+len(payload),
+                           len(records), start_time, end_time))
+        self.num_pending = 0
+
+    def flush(self):
+        # ends the pending chunk, so chunks never straddle a checkpoint
+        if self.num_pending > 0:
+            self.write_chunk()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        index_offset = self.file.tell()
+        self.file.write(INDEX_TAG)
+        self.file.write(np.array(self.index, dtype=chunk_index_dtype).tobytes())
+        self.file.write(TRAILER.pack(index_offset, len(self.index), END_TAG))
+        self.file.close()
+
+class FrameLogger:
+
+    def __init__(self, subject_path, num_fingers, hands, seq_ids,
+                 time_round, finger_round, block_size=4096, num_blocks=4,
+                 sink=None, resume_records=None, storage='binary', chunk_size=1024,
+                 execution_trials=None):
+        self.dtype = frame_dtype(num_fingers)
+        self.hands = list(hands)
+        self.seq_ids = list(seq_ids)
+        self.hand_codes = {hand:i for i, hand in enumerate(self.hands)}
+        self.seq_codes = {seq_id:i for i, seq_id in enumerate(self.seq_ids)}
+        meta = {'num_fingers': num_fingers,
+                'hands': self.hands,
+                'seq_ids': self.seq_ids,
+                'time_round': time_round,
+                'finger_round': finger_round}
+        if sink is None and storage == 'chunked':
+            sink = ChunkedFrameSink(subject_path, meta, chunk_size, execution_trials,
+                                    resume_records)
+        elif sink is None:
+            resume_bytes = None
+            if resume_records is not None:
+                resume_bytes = resume_records*self.dtype.itemsize
+            sink = BinaryFrameSink(subject_path, meta, resume_bytes)
+        self.sink = sink
+        self.records_logged = resume_records if resume_records is not None else 0
+
+        # preallocated blocks cycle between the render thread (filling) and
+        # the writer thread (flushing) through two queues
+        self.free_blocks = queue.Queue()
+        for block in range(num_blocks):
+            self.free_blocks.put(np.zeros(block_size, dtype=self.dtype))
+        self.full_blocks = queue.Queue()
+        self.block = self.free_blocks.get()
+        self.num_records = 0
+        self.error = None
+        self.writer = threading.Thread(target=self.run_writer,
+                                       name='frame-writer', daemon=True)
+        self.writer.start()
+
+    def append(self, trial_time, angles, hand_code, seq_code, trial, run):
+        self.block[self.num_records] = (trial_time, angles, hand_code, seq_code, trial, run)
+        self.num_records += 1
+        self.records_logged += 1
+        if self.num_records == len(self.block):
+            self.hand_off()
+
+    def hand_off(self, flush=False, on_flushed=None):
+        # pass the filled part of the current block to the writer; flush
+        # also has the sink flush once it has written it, then on_flushed()
+        # run on the writer thread
+        if self.error is not None:
+            raise RuntimeError('frame writer failed: '+repr(self.error))
+        self.full_blocks.put((self.block, self.num_records, flush, on_flushed))
+        self.block = self.free_blocks.get() # only waits if the disk is far behind
+        self.num_records = 0
+
+    def run_writer(self):
+        while True:
+            item = self.full_blocks.get()
+            if item is None:
+                break
+            block, num_records, flush, on_flushed = item
+            try:
+                self.sink.write(block[:num_records])
+                if flush:
+                    self.sink.flush()
+                    if on_flushed is not None:
+                        on_flushed()
+            except Exception as e:
+                self.error = e
+            self.free_blocks.put(block)
+            self.full_blocks.task_done()
+        self.sink.flush()
+
+    def flush(self, on_flushed=None):
+        # returns once the writer has written and flushed every record
+        # appended so far, so records_logged is in the file; with
+        # on_flushed, returns at once and the writer thread calls
+        # on_flushed() at that point instead (not if the write failed)
+        self.hand_off(flush=True, on_flushed=on_flushed)
+        if on_flushed is not None:
+            return
+        self.full_blocks.join()
+        if self.error is not None:
+            raise RuntimeError('frame writer failed: '+repr(self.error))
+
+    def close(self):
+        self.flush()
+        self.full_blocks.put(None)
+        self.writer.join()
+        self.sink.close()
+        if self.error is not None:
+            raise RuntimeError('frame writer failed: '+repr(self.error))
+
+def read_frame_bin(subject_path):
+    with open(os.path.join(subject_path, 'frame.json')) as f:
+        meta = json.load(f)
+    records = np.fromfile(os.path.join(subject_path, 'frame.bin'),
+                          dtype=frame_dtype(meta['num_fingers']))
+    return records, meta
+
+def read_frame_chunks(subject_path, run=None, trial=None, execution=None):
+    # records of the chunks matching run/trial/execution (all if None); the
+    # matching chunks of one trial are contiguous and read with a single read
+    with open(os.path.join(subject_path, 'frame.json')) as f:
+        meta = json.load(f)
+    with open(os.path.join(subject_path, 'frame.chunks'), 'rb') as f:
+        index, end = read_chunk_index(f)
+        selected = np.full(len(index), True)
+        for name, value in [('run', run), ('trial', trial), ('execution', execution)]:
+            if value is not None:
+                selected &= index[name] == value
+        index = index[selected]
+        parts = []
+        group_start = 0
+        for i in range(1, len(index)+1):
+            if i < len(index) and index['offset'][i] == index['offset'][i-1]+index['size'][i-1]:
+                continue
+            group = index[group_start:i]
+            f.seek(int(group['offset'][0]))
+            data = f.read(int(group['offset'][-1]+group['size'][-1]-group['offset'][0]))
+            position = 0
+            for size, num_records in zip(group['size'].tolist(), group['num_records'].tolist()):
+                payload = data[position+CHUNK_HEADER.size:position+size]
+                parts.append(decode_chunk(payload, num_records, meta['num_fingers']))
+                position += size
+            group_start = i
+    if len(parts) == 0:
+        return np.zeros(0, dtype=frame_dtype(meta['num_fingers'])), meta
+    return np.concatenate(parts), meta
+
+def read_frame_log(subject_path):
+    # all records of frame.chunks or frame.bin, whichever was written
+    if os.path.exists(os.path.join(subject_path, 'frame.chunks')):
+        return read_frame_chunks(subject_path)
+    return read_frame_bin(subject_path)
+
+def frame_records_to_csv(records, meta, csv_path):
+    # same layout and number formatting as SequenceGame.write_frame
+    with open(csv_path, 'w') as f:
+        f.write('trial_time,')
+        for finger in range(meta['num_fingers']):
+            f.write('f_'+str(finger)+',')
+        f.write('hand,seq_id,trial,run\n')
+        times = np.round(records['trial_time'], meta['time_round']).tolist()
+        angles = np.round(records['angles'], meta['finger_round']).tolist()
+        hands = [meta['hands'][code] for code in records['hand']]
+        seq_ids = [meta['seq_ids'][code] for code in records['seq_id']]
+        for row in zip(times, angles, hands, seq_ids,
+                       records['trial'].tolist(), records['run'].tolist()):
+            f.write(str(row[0])+','
+                    +','.join([str(angle) for angle in row[1]])+','
+                    +row[2]+','+row[3]+','+str(row[4])+','+str(row[5])+'\n')
+
+def frame_bin_to_csv(subject_path):
+    records, meta = read_frame_bin(subject_path)
+    frame_records_to_csv(records, meta, os.path.join(subject_path, 'frame.csv'))
+
+def frame_log_to_csv(subject_path):
+    records, meta = read_frame_log(subject_path)
+    frame_records_to_csv(records, meta, os.path.join(subject_path, 'frame.csv'))
+
+if __name__ == '__main__':
+    # python frame_log.py logs/<subjectid> [...]
+    for subject_path in sys.argv[1:]:
+        frame_log_to_csv(subject_path)
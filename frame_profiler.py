@@ -0,0 +1,117 @@
+import os, time
+import numpy as np
+
+class FrameProfiler:
+
+    def __init__(self, phases, refresh_period, path=None,
+                 drop_tolerance=0.5, max_frames=65536):
+        # per frame: start time and the end time of each phase, from one
+        # monotonic clock, plus the flip timestamp returned by win.flip()
+        self.phases = list(phases)
+        self.refresh_period = refresh_period
+        self.drop_limit = refresh_period*(1.0+drop_tolerance)
+        self.path = path
+        self.stamps = np.zeros((max_frames, len(self.phases)+1))
+        self.flips = np.zeros((max_frames, 5)) # flip time, interval, run, trial, updates
+        self.frame = 0 # row in the buffer
+        self.total_frames = 0
+        self.dropped_frames = 0
+        self.last_flip = None
+        self.clock = time.perf_counter
+        if self.path is not None:
+            with open(self.path, 'w') as f:
+                f.write('frame,start,'+','.join(self.phases)
+                        +',flip_time,flip_interval,dropped,run,trial,updates\n')
+
+    def start_frame(self):
+        self.stamps[self.frame,0] = self.clock()
+
+    def mark(self, phase):
+        # end of phase number phase
+        self.stamps[self.frame,phase+1] = self.clock()
+
+    def end_frame(self, flip_time, run=-1, trial=-1, updates=-1):
+        # updates: stim updates drawn in this frame (-1 if not counted)
+        if flip_time is None:
+            flip_time = self.stamps[self.frame,-1]
+        interval = 0.0 if self.last_flip is None else flip_time-self.last_flip
+        self.last_flip = flip_time
+        if interval > self.drop_limit:
+            self.dropped_frames += 1
+        self.flips[self.frame] = (flip_time, interval, run, trial, updates)
+        self.frame += 1
+        self.total_frames += 1
+        if self.frame == len(self.stamps):
+            self.write_rows()
+
+    def write_rows(self):
+        # durations in seconds for each phase of the buffered frames
+        if self.path is not None and self.frame > 0:
+            stamps = self.stamps[:self.frame]
+            rows = np.column_stack([
+                np.arange(self.total_frames-self.frame, self.total_frames),
+                stamps[:,0], np.diff(stamps, axis=1),
+                self.flips[:self.frame,:2],
+                self.flips[:self.frame,1] > self.drop_limit,
+                self.flips[:self.frame,2:]])
+            with open(self.path, 'a') as f:
+                np.savetxt(f, rows, delimiter=',',
+                    fmt=['%d','%.6f']+['%.6f']*len(self.phases)+['%.6f','%.6f','%d','%d','%d','%d'])
+        self.frame = 0
+
+    def summary(self):
+        # percentiles (ms) of each phase and of the flip interval, read back
+        # from the timing log so that every frame of the session is included
+        if self.path is None:
+            stamps = self.stamps[:self.frame]
+            durations = np.diff(stamps, axis=1)
+            intervals = self.flips[1:self.frame,1]
+        else:
+            data = np.loadtxt(self.path, delimiter=',', skiprows=1, ndmin=2)
+            durations = data[:,2:2+len(self.phases)]
+            intervals = data[1:,2+len(self.phases)+1]
+        lines = ['frames: {}, dropped: {} (flip interval > {:.2f} ms)'.format(
+            self.total_frames, self.dropped_frames, 1000*self.drop_limit)]
+        lines.append('{:>16} {:>8} {:>8} {:>8} {:>8}'.format('phase (ms)','p50','p95','p99','max'))
+        columns = [durations[:,i] for i in range(len(self.phases))]+[intervals]
+        for name, values in zip(self.phases+['flip_interval'], columns):
+            if len(values) == 0:
+                continue
+            p = 1000*np.percentile(values, [50, 95, 99, 100])
+            lines.append('{:>16} {:8.3f} {:8.3f} {:8.3f} {:8.3f}'.format(name, *p))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.path is not None:
+            self.write_rows()
+        text = self.summary()
+        print(text)
+        if self.path is not None:
+            with open(os.path.splitext(self.path)[0]+'_summary.txt', 'w') as f:
+                f.write(text+'\n')
+
+class NullProfiler:
+    # stands in when profiling is off, so the main loop calls cost ~nothing
+
+    def start_frame(self):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def end_frame(self, flip_time, run=-1, trial=-1, updates=-1):
+        pass
+
+    def close(self):
+        pass
+
+def make_profiler(config, win, phases, path=None):
+    if not(config.get('profile_frames', False)):
+        return NullProfiler()
+    refresh_rate = config.get('refresh_rate', None)
+    if refresh_rate:
+        refresh_period = 1.0/refresh_rate
+    else:
+        refresh_period = win.monitorFramePeriod
+    return FrameProfiler(phases, refresh_period, path=path,
+        drop_tolerance=config.get('profile_drop_tolerance', 0.5))
@@ -0,0 +1,227 @@
+import os, json, time, argparse, threading
+from collections import deque
+import numpy as np
+import yaml
+from psychopy import core
+from ExoDisplay import ExoDisplay
+from exo_sim import AngleGenerator
+
+# software input-to-flip latency, per input path and filter setting, against
+# simulated inputs: 'input' runs from a sample's (or key event's) arrival to
+# the flip of the first frame drawn from it, 'press' from the moment a
+# simulated press truly crossed press_angle (or the key event) to the flip
+# of the frame showing that key's keydown colour; no photodiode, so the
+# time from flip to light is not included
+
+class SimExo:
+    # stands in for Exoskeleton: AngleGenerator traces written to position
+    # in real time by a thread, recording when the raw angle of an active
+    # finger crosses the press threshold (true press onsets)
+
+    def __init__(self, generator, clock, threshold, fingers):
+        self.generator = generator
+        self.clock = clock
+        self.threshold = threshold
+        self.fingers = fingers
+        self.position = [generator.rest_angle]*generator.num_fingers
+        self.onsets = deque() # (exo_clock time, finger)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sim-exo', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        above = np.full(self.generator.num_fingers, False)
+        while self.running:
+            while self.generator.t+self.generator.sample_period <= time.perf_counter()-start:
+                t, angles = self.generator.sample()
+                if angles is None:
+                    continue
+                self.position = list(angles)
+                now = self.clock.getTime()
+                crossed = (angles >= self.threshold) & ~above
+                for finger in np.flatnonzero(crossed[self.fingers]):
+                    self.onsets.append((now, int(finger)))
+                above = angles >= self.threshold
+            time.sleep(self.generator.sample_period/2)
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=1.0)
+
+class KeyEvent:
+    def __init__(self, key, type, time):
+        self.key = key
+        self.type = type
+        self.time = time
+
+class SimKeyboard:
+    # iohub-like keyboard: a thread presses random keys at random times,
+    # each event stamped with core time like iohub's hardware timestamps
+
+    def __init__(self, num_keys, press_rate=3.0, hold=(0.05, 0.15), seed=0):
+        self.num_keys = num_keys
+        self.press_rate = press_rate
+        self.hold = hold
+        self.rng = np.random.default_rng(seed)
+        self.events = deque()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='sim-keyboard', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.rng.exponential(1.0/self.press_rate))
+            key = int(self.rng.integers(self.num_keys))
+            self.events.append(KeyEvent(key, 'KEYBOARD_PRESS', core.getTime()))
+            time.sleep(self.rng.uniform(*self.hold))
+            self.events.append(KeyEvent(key, 'KEYBOARD_RELEASE', core.getTime()))
+
+    def getKeys(self):
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+    def stop(self):
+        self.running = False
+
+class SimulatedWindow:
+    # flips on a fixed vsync grid, for runs without a display
+
+    def __init__(self, refresh_rate):
+        self.period = 1.0/refresh_rate
+        self.start = core.getTime()
+
+    def flip(self):
+        now = core.getTime()
+        vsync = self.start+(np.floor((now-self.start)/self.period)+1)*self.period
+        time.sleep(max(vsync-core.getTime(), 0.0))
+        return vsync
+
+def measure(config, win, path, seconds, flip_win=None, seed=0):
+    # latencies (seconds) of one input path: {'input': [...], 'press': [...]}
+    exo_display = ExoDisplay(win, config, exo='deferred')
+    if flip_win is None:
+        flip_win = win
+    fingers = exo_display.hand_fingers[exo_display.cue_display.active_hand]
+    keyboard = exo = None
+    if path == 'exo':
+        generator = AngleGenerator(num_fingers=exo_display.num_fingers,
+            sample_rate=1000, press_angle=1.5*exo_display.press_angle, seed=seed)
+        exo = SimExo(generator, exo_display.exo_clock, exo_display.press_angle, fingers)
+        exo_display.attach_exo(exo)
+    else:
+        keyboard = SimKeyboard(exo_display.num_active_fingers, seed=seed)
+
+    latencies = {'input': [], 'press': []}
+    onsets = {} # key -> true onset time of a press not shown yet
+    pending_inputs = [] # key event times not drawn yet
+    shown_time = exo_display.exo_clock.getTime()
+    end_time = shown_time+seconds
+    while exo_display.exo_clock.getTime() < end_time:
+        if keyboard is not None:
+            for kbe in keyboard.getKeys():
+                event_time = exo_display.exo_time(kbe.time)
+                down = kbe.type == 'KEYBOARD_PRESS'
+                exo_display.key_event(fingers[kbe.key], down, event_time)
+                pending_inputs.append(event_time)
+                if down:
+                    onsets[kbe.key] = event_time
+        else:
+            while exo.onsets:
+                onset, key = exo.onsets.popleft()
+                onsets[key] = onset
+        exo_display.update_inputs()
+
+        # keydown colours, as the games set them
+        shown_presses = []
+        while exo_display.key_events:
+            event_time, key, down = exo_display.key_events.popleft()
+            color = exo_display.success_color if down else exo_display.key_color
+            exo_display.key_stims[key].setBaseColor(color)
+            if down and key in onsets:
+                shown_presses.append(onsets.pop(key))
+
+        if exo is not None:
+            # every sample first drawn in this frame
+            frame_inputs = []
+            for times, angles in exo_display.acquisition.buffer.since(shown_time):
+                frame_inputs.extend(times[times <= exo_display.last_sample_time])
+        else:
+            frame_inputs = pending_inputs
+            pending_inputs = []
+        if exo_display.last_sample_time is not None:
+            shown_time = max(shown_time, exo_display.last_sample_time)
+
+        exo_display.draw()
+        flip_time = exo_display.exo_time(flip_win.flip())
+        latencies['input'].extend(flip_time-np.array(frame_inputs, dtype=float))
+        latencies['press'].extend(flip_time-np.array(shown_presses, dtype=float))
+
+    if keyboard is not None:
+        keyboard.stop()
+    exo_display.close()
+    return latencies
+
+def histogram(values, bin_width=0.002, max_latency=0.1):
+    edges = np.arange(0, max_latency+bin_width, bin_width)
+    counts, edges = np.histogram(np.clip(values, 0, max_latency-1e-9), bins=edges)
+    return counts, edges
+
+def report(name, values, bin_width):
+    values = np.asarray(values)
+    if len(values) == 0:
+        print(name+': no samples')
+        return
+    print('{}: n={} median={:.1f} ms p95={:.1f} ms max={:.1f} ms'.format(name, len(values),
+        1e3*np.median(values), 1e3*np.percentile(values, 95), 1e3*np.max(values)))
+    counts, edges = histogram(values, bin_width)
+    scale = 50.0/max(counts.max(), 1)
+    for count, edge in zip(counts, edges):
+        if count:
+            print('  {:5.1f} ms {:7d} {}'.format(1e3*edge, count, '#'*max(1, int(count*scale))))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Input-to-flip latency against simulated inputs')
+    parser.add_argument('-c','--config', default='demo', help='Configuration file')
+    parser.add_argument('--seconds', type=float, default=20.0, help='Measurement time per condition')
+    parser.add_argument('--paths', default='exo,keyboard', help='Input paths to measure')
+    parser.add_argument('--filter', choices=['on', 'off', 'both'], default='both')
+    parser.add_argument('--headless', action='store_true',
+                        help='No window: flips are simulated on a vsync grid')
+    parser.add_argument('--refresh', type=float, default=60.0, help='Simulated refresh rate (Hz)')
+    parser.add_argument('--bin', type=float, default=2.0, help='Histogram bin width (ms)')
+    parser.add_argument('-o','--output', default=None, help='Write raw latencies to this JSON file')
+    args = parser.parse_args()
+
+    with open(os.path.join('config', args.config+'.yml')) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config['use_exo'] = False
+    if args.headless:
+        win = None
+        flip_win = SimulatedWindow(args.refresh)
+    else:
+        from psychopy import visual
+        win = flip_win = visual.Window(size=(config['screen_width'], config['screen_height']),
+                                       color=config['bg_color'], units='height')
+    filters = {'on': [True], 'off': [False], 'both': [True, False]}[args.filter]
+
+    results = {}
+    for path in args.paths.split(','):
+        for use_filter in filters:
+            name = '{} filter {}'.format(path, 'on' if use_filter else 'off')
+            latencies = measure(dict(config, use_filter=use_filter), win, path,
+                                args.seconds, flip_win=flip_win)
+            results[name] = latencies
+            for kind in ['input', 'press']:
+                report(name+' '+kind, latencies[kind], args.bin/1e3)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'config': args.config, 'headless': args.headless,
+                                'refresh': args.refresh, 'seconds': args.seconds},
+                       'latencies': {name: {kind: [float(v) for v in values]
+                                            for kind, values in latencies.items()}
+                                     for name, latencies in results.items()}}, f)
+    if win is not None:
+        win.close()
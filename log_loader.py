@@ -0,0 +1,167 @@
+import os, sys, json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# schema of the files written by SequenceGame.write_frame_header and
+# write_trial_header; f_*/p_* columns vary with num_fingers/sequence length
+STRING_COLUMNS = ('hand', 'seq_id')
+INT_COLUMNS = ('trial', 'run', 'score')
+LOG_KINDS = ('frame', 'trial')
+
+def csv_dtype(header):
+    fields = []
+    for name in header:
+        if name in STRING_COLUMNS:
+            fields.append((name, 'U16'))
+        elif name in INT_COLUMNS:
+            fields.append((name, 'i4'))
+        else:
+            fields.append((name, 'f8'))
+    return np.dtype(fields)
+
+def read_header(csv_path):
+    with open(csv_path) as f:
+        return f.readline().strip().split(',')
+
+def parse_csv(csv_path):
+    dtype = csv_dtype(read_header(csv_path))
+    return np.loadtxt(csv_path, delimiter=',', skiprows=1, dtype=dtype, ndmin=1)
+
+def csv_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def load_csv(csv_path):
+    # typed columnar array for csv_path, memory-mapped from a .npy sidecar
+    # that is rebuilt whenever the csv's size or mtime changes
+    sidecar_path = csv_path+'.npy'
+    stamp_path = csv_path+'.stamp'
+    stamp = csv_stamp(csv_path)
+    if os.path.exists(sidecar_path) and os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            if json.load(f) == stamp:
+                return np.load(sidecar_path, mmap_mode='r')
+    # written under temporary names and renamed into place, stamp last, so
+    # a concurrent reader never maps a half-written sidecar
+    data = parse_csv(csv_path)
+    suffix = '.{}.tmp'.format(os.getpid())
+    with open(sidecar_path+suffix, 'wb') as f:
+        np.save(f, data)
+    os.replace(sidecar_path+suffix, sidecar_path)
+    with open(stamp_path+suffix, 'w') as f:
+        json.dump(stamp, f)
+    os.replace(stamp_path+suffix, stamp_path)
+    return np.load(sidecar_path, mmap_mode='r')
+
+def load_session(subject_path, kind='frame'):
+    return load_csv(os.path.join(subject_path, kind+'.csv'))
+
+def segments(data):
+    # contiguous row ranges with constant (run, seq_id): [run, seq_id, start, stop]
+    if len(data) == 0:
+        return []
+    run = np.asarray(data['run'])
+    seq_id = np.asarray(data['seq_id'])
+    change = np.flatnonzero((run[1:] != run[:-1]) | (seq_id[1:] != seq_id[:-1]))+1
+    starts = np.concatenate([[0], change])
+    stops = np.concatenate([change, [len(data)]])
+    return [[int(run[start]), str(seq_id[start]), int(start), int(stop)]
+            for start, stop in zip(starts, stops)]
+
+def index_session(subject_path):
+    # parse (or reuse the sidecars of) one session; runs in a worker process
+    entry = {}
+    for kind in LOG_KINDS:
+        csv_path = os.path.join(subject_path, kind+'.csv')
+        if os.path.exists(csv_path):
+            entry[kind] = {'stamp': csv_stamp(csv_path),
+                           'segments': segments(load_csv(csv_path))}
+    return entry
+
+class SessionIndex:
+
+    def __init__(self, log_root='logs', processes=None):
+        self.log_root = log_root
+        self.processes = processes
+        self.index_path = os.path.join(log_root, 'session_index.json')
+        self.sessions = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.sessions = json.load(f)
+        self.update()
+
+    def subject_path(self, subject):
+        return os.path.join(self.log_root, subject)
+
+    def is_current(self, subject):
+        entry = self.sessions.get(subject)
+        if entry is None:
+            return False
+        for kind in LOG_KINDS:
+            csv_path = os.path.join(self.subject_path(subject), kind+'.csv')
+            if os.path.exists(csv_path) != (kind in entry):
+                return False
+            if kind in entry and entry[kind]['stamp'] != csv_stamp(csv_path):
+                return False
+        return True
+
+    def update(self):
+        # (re)index new or changed sessions in parallel across processes
+        subjects = sorted(name for name in os.listdir(self.log_root)
+            if os.path.exists(os.path.join(self.log_root, name, 'frame.csv'))
+            or os.path.exists(os.path.join(self.log_root, name, 'trial.csv')))
+        self.sessions = {s:self.sessions[s] for s in subjects if s in self.sessions}
+        stale = [s for s in subjects if not(self.is_current(s))]
+        if len(stale) == 0:
+            return
+        paths = [self.subject_path(s) for s in stale]
+        if len(stale) == 1:
+            entries = [index_session(paths[0])]
+        else:
+            with ProcessPoolExecutor(self.processes) as pool:
+                entries = list(pool.map(index_session, paths))
+        for subject, entry in zip(stale, entries):
+            self.sessions[subject] = entry
+        with open(self.index_path, 'w') as f:
+            json.dump(self.sessions, f)
+
+    def subjects(self):
+        return list(self.sessions.keys())
+
+    def select(self, kind='frame', subjects=None, runs=None, seq_ids=None):
+        # {subject: rows} for the matching runs/seq_ids; only the sessions with
+        # a matching segment are opened, and only the matching rows are copied
+        selected = {}
+        for subject, entry in self.sessions.items():
+            if (subjects is not None and subject not in subjects) or kind not in entry:
+                continue
+            ranges = [(start, stop) for run, seq_id, start, stop in entry[kind]['segments']
+                      if (runs is None or run in runs)
+                      and (seq_ids is None or seq_id in seq_ids)]
+            if len(ranges) == 0:
+                continue
+            data = load_session(self.subject_path(subject), kind)
+            rows = np.concatenate([np.arange(start, stop) for start, stop in ranges])
+            selected[subject] = data[rows]
+        return selected
+
+    def map_sessions(self, func, kind='frame', subjects=None):
+        # func(subject, data) for each session, spread across processes;
+        # func must be a module-level function so it can be pickled
+        if subjects is None:
+            subjects = [s for s in self.sessions if kind in self.sessions[s]]
+        paths = [self.subject_path(s) for s in subjects]
+        with ProcessPoolExecutor(self.processes) as pool:
+            results = pool.map(apply_to_session, [func]*len(paths), subjects,
+                               paths, [kind]*len(paths))
+            return dict(zip(subjects, results))
+
+def apply_to_session(func, subject, subject_path, kind):
+    return func(subject, load_session(subject_path, kind))
+
+if __name__ == '__main__':
+    # python log_loader.py [log_root]: build or refresh the session index
+    index = SessionIndex(sys.argv[1] if len(sys.argv) > 1 else 'logs')
+    for subject in index.subjects():
+        entry = index.sessions[subject]
+        print(subject, {kind:len(entry[kind]['segments']) for kind in entry})
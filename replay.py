@@ -0,0 +1,183 @@
+import os, time, shutil, argparse
+import numpy as np
+from seq_exp import SequenceGame, parse_args
+from log_loader import parse_csv
+
+class VirtualTime:
+    # shared time base for every virtual clock, advanced by the replay loop
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def clock(self):
+        return VirtualClock(self)
+
+class VirtualClock:
+    # same interface as psychopy.core.Clock
+
+    def __init__(self, time_source):
+        self.time_source = time_source
+        self.reset()
+
+    def getTime(self):
+        return self.time_source.now-self._timeAtLastReset
+
+    def reset(self, newT=0.0):
+        self._timeAtLastReset = self.time_source.now+newT
+
+class FrameCsvPlayer:
+    # replays the filtered angles of a recorded frame.csv: one row per frame
+    # of each 'press' stage, at its recorded trial time; outside the press
+    # stage the next recorded angles are held, and every run is started by
+    # pressing all keys of the active hand
+
+    def __init__(self, frame_csv, frame_period):
+        self.rows = parse_csv(frame_csv)
+        self.finger_columns = [name for name in self.rows.dtype.names
+                               if name.startswith('f_')]
+        self.angles = np.column_stack([self.rows[name] for name in self.finger_columns])
+        self.frame_period = frame_period
+        self.next_row = 0
+
+    def finished(self):
+        return self.next_row >= len(self.rows)
+
+    def start_frame(self, game, time_source):
+        exo_display = game.exo_display
+        if game.exp_stage == 'run' and game.trial_stage == 'press':
+            row = self.next_row
+            time_source.now = (game.exp_clock._timeAtLastReset+game.stage_start
+                               +self.rows['trial_time'][row])
+            self.next_row += 1
+            self.sample = self.angles[row]
+        else:
+            time_source.now += self.frame_period
+            self.sample = self.angles[min(self.next_row, len(self.angles)-1)].copy()
+            if game.exp_stage == 'wait' and not(game.start_initiated):
+                self.sample[:] = exo_display.display_angle_min
+                fingers = exo_display.hand_fingers[exo_display.cue_display.active_hand]
+                self.sample[fingers] = exo_display.press_angle
+        self.sample_time = exo_display.exo_clock.getTime()
+
+    def read_samples(self, exo_display):
+        return [(np.array([self.sample_time]), self.sample[np.newaxis,:])]
+
+class SyntheticPlayer:
+    # presses the cued keys with a fixed inter-press interval, sampled at
+    # sample_rate between frames; error_rate presses a neighbouring key
+
+    def __init__(self, frame_period, sample_rate=1000, ipi=0.15, hold=0.06,
+                 error_rate=0.0, seed=0):
+        self.frame_period = frame_period
+        self.sample_period = 1.0/sample_rate
+        self.ipi = ipi
+        self.hold = hold
+        self.error_rate = error_rate
+        self.rng = np.random.default_rng(seed)
+        self.next_press = None
+        self.pressed_finger = None
+        self.last_sample_time = None
+        self.segments = []
+
+    def finished(self):
+        return False
+
+    def start_frame(self, game, time_source):
+        exo_display = game.exo_display
+        time_source.now += self.frame_period
+        now = exo_display.exo_clock.getTime()
+        if self.last_sample_time is None:
+            self.last_sample_time = now-self.frame_period
+        times = np.arange(self.last_sample_time+self.sample_period, now+1e-12,
+                          self.sample_period)
+        if len(times) == 0:
+            self.segments = []
+            return
+        self.last_sample_time = times[-1]
+        angles = np.full((len(times), exo_display.num_fingers),
+                         float(exo_display.display_angle_min))
+        fingers = exo_display.hand_fingers[exo_display.cue_display.active_hand]
+        down = 1.1*exo_display.display_angle_max
+        if game.exp_stage == 'wait':
+            if not(game.start_initiated):
+                angles[:,fingers] = down
+            self.next_press = None
+        elif game.exp_stage == 'run' and game.trial_stage == 'press':
+            if self.next_press is None:
+                self.next_press = times[0]
+            if self.pressed_finger is None and times[-1] >= self.next_press:
+                key = game.key_to_press
+                if self.rng.random() < self.error_rate:
+                    key = (key+1) % exo_display.num_active_fingers
+                self.pressed_finger = fingers[key]
+                self.press_time = self.next_press
+                self.next_press += self.ipi
+            if self.pressed_finger is not None:
+                held = (times >= self.press_time) & (times < self.press_time+self.hold)
+                angles[held, self.pressed_finger] = down
+                if times[-1] >= self.press_time+self.hold:
+                    self.pressed_finger = None
+        else:
+            self.next_press = None
+            self.pressed_finger = None
+        self.segments = [(times, angles)]
+
+    def read_samples(self, exo_display):
+        return self.segments
+
+def run_headless(game, player, time_source, max_frames=None):
+    # the main loop without check_keys, draw or flip, as fast as possible
+    game.exo_display.sample_source = player
+    frames = 0
+    while game.running:
+        if player.finished() or (max_frames is not None and frames >= max_frames):
+            game.quit()
+            break
+        player.start_frame(game, time_source)
+        game.exo_display.update_inputs()
+        game.run_logic()
+        frames += 1
+    return frames
+
+def make_headless_game(argv, config_overrides=None):
+    time_source = VirtualTime()
+    overrides = {'use_exo': False, 'profile_frames': False}
+    if config_overrides is not None:
+        overrides.update(config_overrides)
+    game = SequenceGame(parse_args(argv), headless=True,
+                        clock_factory=time_source.clock,
+                        config_overrides=overrides)
+    return game, time_source
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless replay of a sequence session')
+    parser.add_argument('-s','--subjectid', default='replay',
+                        help="Subject ID for the replay output ('replay' is overwritten on each run)")
+    parser.add_argument('-c','--config', help='Configuration file', default='demo')
+    parser.add_argument('-r','--replay', help='Session folder whose frame.csv is replayed', default=None)
+    parser.add_argument('--frame-rate', type=float, default=60.0, help='Virtual refresh rate (Hz)')
+    parser.add_argument('--ipi', type=float, default=0.15, help='Synthetic inter-press interval (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Synthetic wrong-key probability')
+    parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    frame_period = 1.0/args.frame_rate
+    subject_path = os.path.join('logs', args.subjectid)
+    if args.replay is not None and os.path.realpath(subject_path) == os.path.realpath(args.replay):
+        parser.error('the replay output would overwrite the replayed session; choose another -s')
+    if args.subjectid == 'replay':
+        shutil.rmtree(subject_path, ignore_errors=True)
+    if args.replay is not None:
+        # read the recording before the game opens its own logs
+        player = FrameCsvPlayer(os.path.join(args.replay, 'frame.csv'), frame_period)
+        # recorded angles are already filtered
+        game, time_source = make_headless_game(['-s', args.subjectid, '-c', args.config],
+                                               {'use_filter': False})
+    else:
+        game, time_source = make_headless_game(['-s', args.subjectid, '-c', args.config])
+        player = SyntheticPlayer(frame_period, ipi=args.ipi, error_rate=args.error_rate)
+    start = time.perf_counter()
+    frames = run_headless(game, player, time_source, args.max_frames)
+    elapsed = time.perf_counter()-start
+    print('{} frames ({:.1f} s virtual) in {:.2f} s: {:.0f} frames/s'.format(
+        frames, time_source.now, elapsed, frames/elapsed))
@@ -0,0 +1,94 @@
+import os, time
+import numpy as np
+
+# the whole session compiled up front, one row per sequence execution, and
+# a one-record checkpoint memory-mapped next to the logs for crash resume
+
+def cue_text(keys):
+    # keys as shown on the cue, e.g. '1 2 3 4 5'
+    return str(np.array(keys)+1)[1:-1]
+
+def schedule_dtype(max_keys):
+    return np.dtype([('run', 'i4'),
+                     ('trial', 'i4'),
+                     ('seq_in_trial', 'i4'),
+                     ('execution', 'i4'), # as the trial column of the logs
+                     ('seq_code', 'u1'),
+                     ('hand_code', 'u1'),
+                     ('cue', 'U64'),
+                     ('num_keys', 'i4'),
+                     ('keys', 'i4', (max_keys,))])
+
+def compile_schedule(config, hands, seq_ids):
+    sequences = config['sequences']
+    num_runs = config['num_runs']
+    trials_per_run = config['trials_per_run']
+    seq_per_trial = config['seq_per_trial']
+    order = config['sequence_order']
+    trial_order = np.tile(order, int(trials_per_run/len(order)))
+    max_keys = max(len(seq['seq']) for seq in sequences.values())
+    schedule = np.zeros(num_runs*trials_per_run*seq_per_trial, dtype=schedule_dtype(max_keys))
+    execution = 0
+    for run in range(num_runs):
+        for trial in range(trials_per_run):
+            seq_id = trial_order[trial]
+            seq = sequences[seq_id]
+            for seq_in_trial in range(seq_per_trial):
+                row = schedule[execution]
+                row['run'] = run
+                row['trial'] = trial
+                row['seq_in_trial'] = seq_in_trial
+                row['execution'] = execution
+                row['seq_code'] = seq_ids.index(seq_id)
+                row['hand_code'] = hands.index(seq['hand'])
+                row['cue'] = cue_text(seq['seq'])
+                row['num_keys'] = len(seq['seq'])
+                row['keys'][:len(seq['seq'])] = seq['seq']
+                execution += 1
+    return schedule
+
+checkpoint_dtype = np.dtype([('run', 'i4'), # next trial to run
+                             ('trial', 'i4'),
+                             ('score', 'i8'),
+                             ('frame_offset', 'i8'), # bytes, or records for frame.bin/frame.chunks
+                             ('trial_offset', 'i8'), # bytes of trial.csv
+                             ('summary_offset', 'i8'), # bytes of summary.csv
+                             ('resumes', 'i4'),
+                             ('saved_at', 'f8')]) # unix time
+
+class Checkpoint:
+    # one record in checkpoint.npy, updated in place at trial boundaries
+
+    def __init__(self, subject_path, resume=False):
+        self.path = os.path.join(subject_path, 'checkpoint.npy')
+        if resume:
+            if not(os.path.exists(self.path)):
+                raise RuntimeError('no checkpoint to resume from in '+subject_path)
+            self.record = np.lib.format.open_memmap(self.path, mode='r+')
+        else:
+            self.record = np.lib.format.open_memmap(self.path, mode='w+',
+                dtype=checkpoint_dtype, shape=(1,))
+
+    def get(self, field):
+        return self.record[field][0].item()
+
+    def save(self, **fields):
+        for name, value in fields.items():
+            self.record[name] = value
+        self.record['saved_at'] = time.time()
+        self.record.flush()
+
+    def close(self):
+        del self.record
+
+def truncate_log(path, offset):
+    # cut path back to offset bytes; the cut tail (from a trial that never
+    # finished) is kept in path+'.aborted'
+    with open(path, 'r+b') as f:
+        offset = min(offset, os.fstat(f.fileno()).st_size)
+        f.seek(offset)
+        tail = f.read()
+        if tail:
+            with open(path+'.aborted', 'ab') as aborted:
+                aborted.write(tail)
+        f.truncate(offset)
@@ -1,68 +1,144 @@
-import os, sys, yaml, argparse
+import os, sys, yaml, argparse, threading, traceback
 import numpy as np
-from psychopy import core, event, visual
-from ExoDisplay import ExoDisplay
+from psychopy import core
+from ExoDisplay import ExoDisplay, TextCache, connect_exo
+from exo_input import run_at_rate
+from frame_log import FrameLogger, frame_bin_to_csv
+from frame_profiler import make_profiler, NullProfiler
+from seq_stats import SequenceStats
+from startup import StartupTimer, BackgroundTask, load_images
+from schedule import compile_schedule, Checkpoint, truncate_log
 
 # interpret command line arguments
-parser = argparse.ArgumentParser(description='Sequence learning experiment parameters')
-parser.add_argument('-s','--subjectid', help='Subject ID',default='demo')
-parser.add_argument('-c','--config', help='Configuration file',default='demo')
-parser.add_argument('-fs','--fullscreen', help='Fullscreen mode', action='store_true', default=False)
-args = parser.parse_args()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Sequence learning experiment parameters')
+    parser.add_argument('-s','--subjectid', help='Subject ID',default='demo')
+    parser.add_argument('-c','--config', help='Configuration file',default='demo')
+    parser.add_argument('-fs','--fullscreen', help='Fullscreen mode', action='store_true', default=False)
+    parser.add_argument('-r','--resume', help='Resume the session from its checkpoint', action='store_true', default=False)
+    return parser.parse_args(argv)
+
+def validate_config(config):
+    # catch sequence/order mistakes before any window or device is opened
+    errors = []
+    for seq_id, seq in config['sequences'].items():
+        if seq['hand'] not in ['left', 'right']:
+            errors.append('sequence {}: unknown hand {}'.format(seq_id, seq['hand']))
+        if not(all(0 <= key < config['num_active_fingers'] for key in seq['seq'])):
+            errors.append('sequence {}: key out of range'.format(seq_id))
+    for seq_id in config['sequence_order']:
+        if seq_id not in config['sequences']:
+            errors.append('sequence_order: unknown sequence {}'.format(seq_id))
+    if config['trials_per_run'] % len(config['sequence_order']) != 0:
+        errors.append('trials_per_run should be a multiple of len(sequence_order)')
+    if errors:
+        raise ValueError('invalid configuration: '+'; '.join(errors))
+
+def launch_keyboard():
+    from psychopy.iohub.client import launchHubServer
+    return launchHubServer()
 
 class SequenceGame:
 
-    def __init__(self):
+    def __init__(self, args, headless=False, clock_factory=None, config_overrides=None):
         # load command line args
         self.args = args
+        # headless: no window, stims or keyboard, and quit() returns instead
+        # of exiting; clocks come from clock_factory (e.g. a virtual clock)
+        self.headless = headless
+        self.Clock = clock_factory if clock_factory is not None else core.Clock
+        self.running = True
+        self.startup = StartupTimer()
 
         # load config
-        try:
-            with open(os.path.join('config',self.args.config+'.yml')) as f:
-                self.config = yaml.load(f, Loader=yaml.FullLoader)
-        except:
-            print('Configuration file '+self.args.config+'.yml not found')
-            sys.exit(1)
+        with self.startup.stage('config'):
+            try:
+                with open(os.path.join('config',self.args.config+'.yml')) as f:
+                    self.config = yaml.load(f, Loader=yaml.FullLoader)
+            except:
+                print('Configuration file '+self.args.config+'.yml not found')
+                sys.exit(1)
+            if config_overrides is not None:
+                self.config.update(config_overrides)
+            validate_config(self.config)
+
+        # independent, thread-safe start-up work runs in the background while
+        # the window and stims are built: the exo connection and png
+        # decoding; GL calls and the iohub launch stay on this thread
+        exo_task = images_task = None
+        self.game_process = None
+        if not(self.headless):
+            if self.config['use_exo'] and self.config.get('shared_input', False):
+                # the exo, trial logic and logs run in a child process; this
+                # one only draws the state it shares (see shared_input.py)
+                from shared_input import GameProcess
+                with self.startup.stage('game process'):
+                    self.game_process = GameProcess(self.args, self.config,
+                        config_overrides, rate=self.config.get('shared_input_rate', 250))
+            elif self.config['use_exo']:
+                exo_task = BackgroundTask(connect_exo, self.config)
+            images_task = BackgroundTask(load_images, ['hand-light.png', 'hand-dark.png'])
 
         # set display 
-        self.win = visual.Window(size=(self.config['screen_width'], self.config['screen_height']),
-                                 color=self.config['bg_color'], units='height',
-                                 fullscr=self.args.fullscreen)
-        self.exo_display = ExoDisplay(self.win, config=self.config)
+        if self.headless:
+            self.win = None
+        else:
+            with self.startup.stage('window'):
+                from psychopy import visual
+                self.win = visual.Window(size=(self.config['screen_width'], self.config['screen_height']),
+                                         color=self.config['bg_color'], units='height',
+                                         fullscr=self.args.fullscreen)
+            if not(self.config['use_exo']):
+                # iohub's keyboard needs the window, and its launch is not
+                # safe off the main thread
+                with self.startup.stage('iohub launch'):
+                    self.io = launch_keyboard()
+                    self.kb = self.io.devices.keyboard
+                    self.key_codes = ['q','w','e','r','v','n','u','i','o','p']
+                    self.key_to_finger = {key:finger for finger, key in enumerate(self.key_codes)}
+        with self.startup.stage('stims'):
+            self.exo_display = ExoDisplay(self.win, config=self.config,
+                clock_factory=self.Clock,
+                exo='deferred' if exo_task is not None or self.game_process is not None else None,
+                images=images_task.result() if images_task is not None else None)
 
         # file recording
         self.finger_round = self.config['finger_round']
         self.time_round = self.config['time_round']
+        self.frame_log = self.config.get('frame_log', 'csv') # 'csv', 'binary' or 'chunked'
         self.subject_path = os.path.join('logs',self.args.subjectid)
-        if self.args.subjectid != 'demo':
-            if os.path.exists(self.subject_path):
-                raise RuntimeError('subject path already exists!')
-        if not(os.path.exists(self.subject_path)): os.mkdir(self.subject_path)
+        if self.game_process is None: # else checked and created by the game process
+            if self.args.resume:
+                if not(os.path.exists(os.path.join(self.subject_path, 'checkpoint.npy'))):
+                    raise RuntimeError('no checkpoint to resume from in '+self.subject_path)
+            elif self.args.subjectid != 'demo':
+                if os.path.exists(self.subject_path):
+                    raise RuntimeError('subject path already exists! (use --resume to continue it)')
+            if not(os.path.exists(self.subject_path)): os.mkdir(self.subject_path)
 
         # add key controls
-        event.globalKeys.add(key='q', modifiers=['ctrl'], func=self.quit)
-
-        if not(self.exo_display.exo_active):
-            from psychopy.iohub.client import launchHubServer
-            self.io = launchHubServer()
-            self.kb = self.io.devices.keyboard
-            self.key_codes = ['q','w','e','r','v','n','u','i','o','p']
+        if not(self.headless):
+            from psychopy import event
+            event.globalKeys.add(key='q', modifiers=['ctrl'], func=self.quit)
 
         self.run_msg_text = 'Run {} of {}'
         self.exp_end_text = 'All done!'
-        self.run_msg = visual.TextStim(win=self.win,
-            text='', pos=(0,-0.2),
-            color=self.exo_display.cue_color,
-            height=0.08)
+        self.run_msgs = TextCache(self.win, pos=(0,-0.2), height=0.08)
+        self.run_msgs.prepare([self.run_msg_text.format(run+1,self.config['num_runs'])
+            for run in range(self.config['num_runs'])]+[self.exp_end_text],
+            self.exo_display.cue_color)
+        self.run_msg = self.run_msgs.get('', self.exo_display.cue_color)
         self.score_msg_text = 'Total score: {}'
-        self.score_msg = visual.TextStim(win=self.win,
-            text='', pos=(0,-0.3),
-            color=self.exo_display.success_color,
-            height=0.08)
-
-        # sequence learning variables
-        self.trial_clock = core.Clock()
-        self.start_clock = core.Clock()
+        self.score_msgs = TextCache(self.win, pos=(0,-0.3), height=0.08)
+        self.score_msg = self.score_msgs.get('', self.exo_display.success_color)
+        self.score_text = '' # score_msg is rebuilt by draw() when this changes
+        self.shown_score_text = ''
+
+        # sequence learning variables; stages run against absolute deadlines
+        # on exp_clock (never reset), so late ticks do not add up over a run
+        self.exp_clock = self.Clock()
+        self.stage_start = 0.0 # exp_clock time the current stage started
+        self.start_time = 0.0 # exp_clock time all start keys were pressed
         self.start_hand = self.config['start_hand']
         self.trial_stage = 'cue' # ['cue', 'press', 'feedback']
         self.seq_in_trial = 0
@@ -74,34 +150,152 @@ class SequenceGame:
         self.NUM_RUNS = self.config['num_runs']
         self.TRIALS_PER_RUN = self.config['trials_per_run']
         self.SEQUENCES = self.config['sequences']
+        self.SEQ_IDS = list(self.SEQUENCES.keys())
+        self.HANDS = ['left', 'right']
+        # every execution of the session, in order
+        self.schedule = compile_schedule(self.config, self.HANDS, self.SEQ_IDS)
+        self.exo_display.cue_display.prepare_cues(
+            [str(cue) for cue in np.unique(self.schedule['cue'])])
         self.trial_num = 0
         self.run_num = 0
         self.score = 0
-        self.trial_base_order = self.config['sequence_order']
-        self.trial_order = np.tile(self.trial_base_order,
-            int(self.TRIALS_PER_RUN/len(self.trial_base_order)))
-        self.seq_times = {}
+        # online movement-time statistics of correct executions
+        self.FEEDBACK_RECENT = self.config.get('feedback_recent', False)
+        self.seq_stats = {}
         for k in self.SEQUENCES.keys():
-            self.seq_times[k] = np.array([])
-        self.set_sequence()
-        self.write_frame_header()
-        self.write_trial_header() 
-        self.reset_for_start()
+            self.seq_stats[k] = SequenceStats(window=self.config.get('stats_window', 10))
+        self.execution_num = 0
+        # fixed-rate logic thread (Hz); 0 runs the logic once per frame
+        self.LOGIC_RATE = self.config.get('logic_rate', 0)
+        self.state_lock = threading.Lock()
+        self.logic_thread = None
+        self.quit_requested = False
+        if self.game_process is not None:
+            with self.startup.stage('game process (wait)'):
+                self.game_process.wait_ready()
+        else:
+            # next unfinished trial and log sizes, saved at each trial boundary
+            self.checkpoint = Checkpoint(self.subject_path, resume=self.args.resume)
+            if self.args.resume:
+                self.resume_from_checkpoint()
+            self.set_sequence()
+            self.write_frame_header()
+            self.write_trial_header() 
+            self.write_summary_header()
+            if not(self.args.resume):
+                self.save_checkpoint(0)
+            self.reset_for_start()
+
+        # per-frame phase timing, written next to frame.csv
+        if self.headless:
+            self.profiler = NullProfiler()
+        else:
+            timing_name = 'timing.csv'
+            if self.args.resume:
+                resumes = (self.game_process.resumes() if self.game_process is not None
+                           else self.checkpoint.get('resumes'))
+                timing_name = 'timing_resume{}.csv'.format(resumes)
+            phases = ['check_keys', 'update_inputs', 'logic', 'draw', 'flip']
+            if self.game_process is not None: # everything but drawing is in the child
+                phases = ['read_state', 'draw', 'flip']
+            elif self.LOGIC_RATE > 0: # inputs and logic run on the logic thread
+                phases = ['check_keys', 'copy_state', 'draw', 'flip']
+            self.profiler = make_profiler(self.config, self.win, phases,
+                path=os.path.join(self.subject_path, timing_name))
+
+        # wait for the background start-up work
+        if exo_task is not None:
+            with self.startup.stage('exo connect (wait)'):
+                self.exo_display.attach_exo(exo_task.result())
+            self.startup.add_task('exo connect', exo_task)
+        if images_task is not None:
+            self.startup.add_task('png decode', images_task)
+
+        if not(self.headless):
+            with self.startup.stage('warm-up'):
+                self.warm_up()
+            self.startup.report(os.path.join(self.subject_path, 'startup.txt'))
+
+    def warm_up(self):
+        # pre-draw every stim once, so first-use texture and shader costs are
+        # paid here instead of in trial 0, then discard the drawing
+        self.exo_display.warm_up()
+        self.run_msgs.warm_up()
+        self.score_msgs.warm_up()
+        self.win.clearBuffer()
+        self.win.flip()
+
+    def execution_index(self, run, trial, seq_in_trial):
+        # schedule row, which is also the sequence execution number
+        return (seq_in_trial+trial*self.SEQ_PER_TRIAL
+                +run*(self.SEQ_PER_TRIAL*self.TRIALS_PER_RUN))
 
     def set_sequence(self):
-        self.next_seq_id = self.trial_order[self.trial_num]
+        # a finished session (resumed) keeps the last sequence for its end screen
+        row = self.schedule[min(self.execution_index(self.run_num, self.trial_num, 0),
+                                len(self.schedule)-1)]
+        self.seq_code = int(row['seq_code'])
+        self.hand_code = int(row['hand_code'])
+        self.next_seq_id = self.SEQ_IDS[self.seq_code]
         self.next_seq = self.SEQUENCES[self.next_seq_id]
-        self.exo_display.cue_display.active_hand = self.next_seq['hand']
-        self.sequence = np.array(self.next_seq['seq'])
+        self.exo_display.cue_display.active_hand = self.HANDS[self.hand_code]
+        self.sequence = row['keys'][:row['num_keys']]
+        self.cue_text = str(row['cue'])
+
+    def save_checkpoint(self, trial_num):
+        # called between trials: everything logged so far belongs to
+        # finished trials, and trial_num of this run is the next one
+        run_num = self.run_num
+        if trial_num >= self.TRIALS_PER_RUN:
+            trial_num = 0
+            run_num += 1
+        self.trial_file.flush()
+        self.summary_file.flush()
+        fields = dict(run=run_num, trial=trial_num, score=self.score,
+            trial_offset=self.trial_file.tell(), summary_offset=self.summary_file.tell())
+        if self.frame_log != 'csv':
+            # saved by the frame writer thread once the frames logged so far
+            # are on disk, so the logic thread never waits for the disk; the
+            # writer is then the only thread that writes the checkpoint
+            fields['frame_offset'] = self.frame_logger.records_logged
+            self.frame_logger.flush(on_flushed=lambda: self.checkpoint.save(**fields))
+        else:
+            self.frame_file.flush()
+            self.checkpoint.save(frame_offset=self.frame_file.tell(), **fields)
+
+    def resume_from_checkpoint(self):
+        # continue at the next unfinished trial; logs are cut back to the
+        # checkpoint and appended to, and the statistics rebuilt from trial.csv
+        checkpoint = self.checkpoint
+        self.run_num = checkpoint.get('run')
+        self.trial_num = checkpoint.get('trial')
+        self.score = checkpoint.get('score')
+        if self.frame_log == 'csv':
+            truncate_log(os.path.join(self.subject_path, 'frame.csv'),
+                         checkpoint.get('frame_offset'))
+        trial_path = os.path.join(self.subject_path, 'trial.csv')
+        truncate_log(trial_path, checkpoint.get('trial_offset'))
+        truncate_log(os.path.join(self.subject_path, 'summary.csv'),
+                     checkpoint.get('summary_offset'))
+        with open(trial_path) as f:
+            lines = f.read().splitlines()
+        header = lines[0].split(',')
+        for line in lines[1:]:
+            row = dict(zip(header, line.split(',')))
+            if int(row['score']) > 0: # correct executions only
+                self.seq_stats[row['seq_id']].add(float(row['move_time']))
+        checkpoint.save(resumes=checkpoint.get('resumes')+1)
 
     def reset_for_start(self):
         self.exp_stage = 'wait'
         if self.run_num > 0:
-            self.score_msg.text = self.score_msg_text.format(self.score)
+            # built by draw(), between runs, since the score is not known ahead
+            self.score_text = self.score_msg_text.format(self.score)
         if self.run_num < self.NUM_RUNS:
-            self.run_msg.text = self.run_msg_text.format(self.run_num+1,self.NUM_RUNS)
+            self.run_msg = self.run_msgs.get(
+                self.run_msg_text.format(self.run_num+1,self.NUM_RUNS), self.exo_display.cue_color)
         else:
-            self.run_msg.text = self.exp_end_text
+            self.run_msg = self.run_msgs.get(self.exp_end_text, self.exo_display.cue_color)
         self.exo_display.cue_display.set_for_start(self.start_hand)
         for key in self.exo_display.key_stims:
             key.setBaseColor(self.exo_display.cue_color)
@@ -109,8 +303,6 @@ class SequenceGame:
         self.start_initiated = False
 
     def wait_for_start(self):
-        self.run_msg.draw()
-        self.score_msg.draw()
         for pressed_key in np.where(self.exo_display.keydowns==True)[0]:
             self.start_keys_pressed[pressed_key] = True
             self.exo_display.key_stims[pressed_key].setBaseColor(self.exo_display.success_color)
@@ -118,25 +310,41 @@ class SequenceGame:
         if ((sum(self.start_keys_pressed)>=self.exo_display.num_active_fingers)
                 and not(self.start_initiated)):
             self.start_initiated = True
-            self.start_clock.reset()
+            self.start_time = self.exp_clock.getTime()
 
-        if self.start_initiated and self.start_clock.getTime()>self.START_WAIT_TIME:
+        if (self.start_initiated
+                and self.exp_clock.getTime()-self.start_time > self.START_WAIT_TIME):
             if self.run_num < self.NUM_RUNS:
-                self.reset_for_exp()
+                self.reset_for_exp(self.start_time+self.START_WAIT_TIME)
             else:
                 self.quit()
 
-    def reset_for_exp(self):
+    def reset_for_exp(self, start_time=None):
+        if start_time is None:
+            start_time = self.exp_clock.getTime()
         self.exp_stage = 'run'
-        self.reset_for_trial()
+        self.reset_for_trial(start_time)
 
-    def reset_for_trial(self):
+    def reset_for_trial(self, start_time):
         self.set_sequence()
         self.seq_in_trial = 0
         self.trial_stage = 'cue'
-        self.trial_clock.reset()
+        self.stage_start = start_time
         self.reset_for_seq()
 
+    def stage_time(self):
+        return self.exp_clock.getTime()-self.stage_start
+
+    def exo_stage_start(self):
+        # the current stage's start in exo_clock time, the clock of key events
+        return self.exo_display.exo_clock.getTime()-self.stage_time()
+
+    def next_stage(self, stage, duration):
+        # the next stage starts at the current one's deadline, not when the
+        # deadline was noticed
+        self.trial_stage = stage
+        self.stage_start += duration
+
     def reset_for_seq(self):
         for key in self.exo_display.key_stims:
             key.setBaseColor(self.exo_display.key_color)
@@ -144,11 +352,37 @@ class SequenceGame:
         self.key_to_press = self.sequence[0]
         self.correct_in_seq = np.full(len(self.sequence),False)
         self.seq_timings = np.full(len(self.sequence),0.0)
+        self.execution_num = self.execution_index(self.run_num, self.trial_num,
+                                                  self.seq_in_trial)
 
     def reset_new_keydowns(self):
-        self.exo_display.new_keydowns[:] = False
+        # drop the key events from before the current stage's start; those
+        # between that deadline and this frame belong to the new stage
+        exo_display = self.exo_display
+        stage_start = self.exo_stage_start()
+        key_events = [event for event in exo_display.key_events if event[0] >= stage_start]
+        exo_display.key_events.clear()
+        exo_display.key_events.extend(key_events)
+        exo_display.new_keydowns[:] = False
+        for event_time, key, down in key_events:
+            if down:
+                exo_display.new_keydowns[key] = True
 
     def write_frame_header(self):
+        if self.frame_log != 'csv':
+            # records are written by a background thread; frame.bin is
+            # converted to frame.csv at quit, frame.chunks is kept compressed
+            self.frame_logger = FrameLogger(self.subject_path,
+                self.config['num_fingers'], self.HANDS, self.SEQ_IDS,
+                time_round=self.time_round, finger_round=self.finger_round,
+                block_size=self.config.get('frame_log_block', 4096),
+                resume_records=self.checkpoint.get('frame_offset') if self.args.resume else None,
+                storage=self.frame_log, chunk_size=self.config.get('frame_log_chunk', 1024),
+                execution_trials=self.schedule['trial'])
+            return
+        if self.args.resume:
+            self.frame_file = open(self.subject_path+'/frame.csv','a')
+            return
         self.frame_file = open(self.subject_path+'/frame.csv','w')
         self.frame_file.write('trial_time,')
         for finger in range(self.config['num_fingers']):
@@ -159,8 +393,13 @@ class SequenceGame:
         self.frame_file.write('run\n')
 
     def write_frame(self):
+        if self.frame_log != 'csv':
+            self.frame_logger.append(self.stage_time(),
+                self.exo_display.angle_filt, self.hand_code, self.seq_code,
+                self.execution_num, self.run_num)
+            return
         self.frame_file.write(
-            str(np.round(self.trial_clock.getTime(),self.time_round))
+            str(np.round(self.stage_time(),self.time_round))
                 +',')
         for finger in range(self.config['num_fingers']):
             self.frame_file.write(
@@ -168,13 +407,13 @@ class SequenceGame:
                 +',')
         self.frame_file.write(self.next_seq['hand']+',')
         self.frame_file.write(self.next_seq_id+',')
-        sequence_execution_num = (self.seq_in_trial   
-            +self.trial_num*self.SEQ_PER_TRIAL
-            +self.run_num*(self.SEQ_PER_TRIAL*self.TRIALS_PER_RUN))
-        self.frame_file.write(str(sequence_execution_num)+',')
+        self.frame_file.write(str(self.execution_num)+',')
         self.frame_file.write(str(self.run_num)+'\n')
 
     def write_trial_header(self):
+        if self.args.resume:
+            self.trial_file = open(self.subject_path+'/trial.csv','a')
+            return
         self.trial_file = open(self.subject_path+'/trial.csv','w')
         self.trial_file.write('move_time,')
         for press in range(len(self.sequence)):
@@ -193,107 +432,260 @@ class SequenceGame:
         self.trial_file.write(str(self.add_score)+',')
         self.trial_file.write(self.next_seq['hand']+',')
         self.trial_file.write(self.next_seq_id+',')
-        sequence_execution_num = (self.seq_in_trial   
-            +self.trial_num*self.SEQ_PER_TRIAL
-            +self.run_num*(self.SEQ_PER_TRIAL*self.TRIALS_PER_RUN))
-        self.trial_file.write(str(sequence_execution_num)+',')
+        self.trial_file.write(str(self.execution_num)+',')
         self.trial_file.write(str(self.run_num)+'\n')
 
+    def write_summary_header(self):
+        self.summary_keys = list(SequenceStats(window=1).summary().keys())
+        if self.args.resume:
+            self.summary_file = open(self.subject_path+'/summary.csv','a')
+            return
+        self.summary_file = open(self.subject_path+'/summary.csv','w')
+        self.summary_file.write(','.join(self.summary_keys)+',hand,seq_id,trial,run\n')
+
+    def write_summary(self):
+        # running statistics of this trial's sequence, once per trial
+        summary = self.seq_stats[self.next_seq_id].summary()
+        for key in self.summary_keys:
+            self.summary_file.write(str(np.round(summary[key],self.time_round))+',')
+        self.summary_file.write(self.next_seq['hand']+',')
+        self.summary_file.write(self.next_seq_id+',')
+        self.summary_file.write(str(self.trial_num)+',')
+        self.summary_file.write(str(self.run_num)+'\n')
+
     def run_trial(self):
-        self.exo_display.cue_display.draw()
         if self.trial_stage == 'cue':
-            self.exo_display.cue_display.set_cue(
-                seq=str(self.sequence+1)[1:-1])
-            if self.trial_clock.getTime() > self.CUE_TIME:
-                self.trial_stage = 'press'
+            self.exo_display.cue_display.set_cue(seq=self.cue_text)
+            if self.stage_time() > self.CUE_TIME:
+                self.next_stage('press', self.CUE_TIME)
                 self.exo_display.cue_display.set_all_idle()
                 self.reset_new_keydowns()
-                self.trial_clock.reset()
         elif self.trial_stage == 'press':
             self.write_frame()
             self.key_to_press = self.sequence[self.key_num_to_press]
             self.exo_display.key_stims[self.key_to_press].setBaseColor(self.exo_display.cue_color)
-            if any(self.exo_display.new_keydowns):
-                pressed_key = np.where(self.exo_display.new_keydowns==True)[0][0]
-                if pressed_key == self.key_to_press:
-                    self.correct_in_seq[self.key_num_to_press] = True
-                    self.exo_display.key_stims[self.key_to_press].setBaseColor(self.exo_display.success_color)
-                else:
-                    self.correct_in_seq[self.key_num_to_press] = False
-                    self.exo_display.key_stims[self.key_to_press].setBaseColor(self.exo_display.fail_color)
-                self.seq_timings[self.key_num_to_press] = self.trial_clock.getTime()
-                self.key_num_to_press += 1
-                self.exo_display.new_keydowns[:] = False
-                if self.key_num_to_press >= len(self.sequence):
-                    self.trial_stage = 'feedback'
-                    self.seq_time = self.seq_timings[-1]-self.seq_timings[0]
-                    if all(self.correct_in_seq):
-                        self.seq_correct = True
-                        self.seq_times[self.next_seq_id] = np.append(self.seq_times[self.next_seq_id],self.seq_time)
-                        if self.seq_time < np.median(self.seq_times[self.next_seq_id]):
-                            self.exo_display.cue_display.set_feedback('fast')
-                            self.add_score = 3
-                        else:
-                            self.exo_display.cue_display.set_feedback('success')
-                            self.add_score = 1
-                    else:
-                        self.seq_correct = False
-                        self.exo_display.cue_display.set_feedback('fail')
-                        self.add_score = 0
-                    self.score += self.add_score
-                    self.write_trial()
-                    self.trial_clock.reset()
-                    self.seq_in_trial+=1
+            # every press since the last frame, in order, with its own time
+            key_events = self.exo_display.key_events
+            while key_events and self.trial_stage == 'press':
+                event_time, pressed_key, down = key_events.popleft()
+                if down:
+                    self.register_press(pressed_key, event_time)
         elif self.trial_stage == 'feedback':
-            if self.trial_clock.getTime() > self.FEEDBACK_TIME:
+            if self.stage_time() > self.FEEDBACK_TIME:
                 self.exo_display.cue_display.set_all_idle()
                 if self.seq_in_trial < self.SEQ_PER_TRIAL:
                     self.reset_for_seq()
-                    self.trial_clock.reset()
-                    self.trial_stage = 'press'
+                    self.next_stage('press', self.FEEDBACK_TIME)
                     self.reset_new_keydowns()
                 else:
-                    self.trial_stage = 'iti'
-                    self.trial_clock.reset()
+                    self.next_stage('iti', self.FEEDBACK_TIME)
+                    self.write_summary()
+                    self.save_checkpoint(self.trial_num+1)
                     self.reset_for_seq()
         elif self.trial_stage == 'iti':
-            if self.trial_clock.getTime() > self.ITI_TIME:
+            if self.stage_time() > self.ITI_TIME:
                 self.trial_num += 1
                 if self.trial_num >= self.TRIALS_PER_RUN:
                     self.trial_num = 0
                     self.run_num += 1
                     self.reset_for_start()
                 else:
-                    self.reset_for_trial()
+                    self.reset_for_trial(self.stage_start+self.ITI_TIME)
+
+    def register_press(self, pressed_key, press_time):
+        # one keydown in the press stage; press_time in exo_clock time
+        self.key_to_press = self.sequence[self.key_num_to_press]
+        if pressed_key == self.key_to_press:
+            self.correct_in_seq[self.key_num_to_press] = True
+            self.exo_display.key_stims[self.key_to_press].setBaseColor(self.exo_display.success_color)
+        else:
+            self.correct_in_seq[self.key_num_to_press] = False
+            self.exo_display.key_stims[self.key_to_press].setBaseColor(self.exo_display.fail_color)
+        # press time from the keydown's own timestamp, not frame time; a
+        # press stamped before the stage started (e.g. a keyboard press
+        # held across the deadline) counts as at its start
+        press_offset = press_time-self.exo_stage_start()
+        if press_offset < 0:
+            print('warning: press {:.3f} s before the press stage, logged as 0'.format(
+                -press_offset))
+            press_offset = 0.0
+        self.seq_timings[self.key_num_to_press] = press_offset
+        self.key_num_to_press += 1
+        if self.key_num_to_press >= len(self.sequence):
+            self.seq_time = self.seq_timings[-1]-self.seq_timings[0]
+            if all(self.correct_in_seq):
+                self.seq_correct = True
+                stats = self.seq_stats[self.next_seq_id]
+                stats.add(self.seq_time)
+                if self.FEEDBACK_RECENT:
+                    reference_time = stats.recent_median()
+                else:
+                    reference_time = stats.median()
+                if self.seq_time < reference_time:
+                    self.exo_display.cue_display.set_feedback('fast')
+                    self.add_score = 3
+                else:
+                    self.exo_display.cue_display.set_feedback('success')
+                    self.add_score = 1
+            else:
+                self.seq_correct = False
+                self.exo_display.cue_display.set_feedback('fail')
+                self.add_score = 0
+            self.score += self.add_score
+            self.write_trial()
+            # feedback starts at the final press
+            self.next_stage('feedback', self.seq_timings[-1])
+            self.seq_in_trial+=1
 
     def check_keys(self):
         events = self.kb.getKeys()
         for kbe in events:
-            if kbe.key in self.key_codes:
+            finger = self.key_to_finger.get(kbe.key)
+            if finger is not None:
                 if kbe.type == 'KEYBOARD_PRESS':
-                    self.exo_display.spoof_keydowns[int(np.where(kbe.key==np.array(self.key_codes))[0])]=True
+                    self.exo_display.key_event(finger, True, self.exo_display.exo_time(kbe.time))
                 elif kbe.type == 'KEYBOARD_RELEASE':
-                    self.exo_display.spoof_keydowns[int(np.where(kbe.key==np.array(self.key_codes))[0])]=False
+                    self.exo_display.key_event(finger, False, self.exo_display.exo_time(kbe.time))
+
+    def run_logic(self):
+        if self.exp_stage == 'wait':
+            self.wait_for_start()
+        elif self.exp_stage == 'run':
+            self.run_trial()
+
+    def draw_state(self):
+        # copy of the game state draw() shows (see run_threaded_loop)
+        return {'exp_stage': self.exp_stage,
+                'score_text': self.score_text,
+                'run_msg': self.run_msg,
+                'exo_display': self.exo_display.display_state()}
+
+    def draw(self, state=None):
+        if state is None:
+            exp_stage, score_text, run_msg = self.exp_stage, self.score_text, self.run_msg
+            exo_state = None
+        else:
+            exp_stage, score_text, run_msg = state['exp_stage'], state['score_text'], state['run_msg']
+            exo_state = state['exo_display']
+        if exp_stage == 'wait':
+            if score_text != self.shown_score_text:
+                self.score_msg = self.score_msgs.get(score_text,
+                    self.exo_display.success_color)
+                self.shown_score_text = score_text
+            run_msg.draw()
+            self.score_msg.draw()
+        self.exo_display.draw(exo_state)
 
     def run_main_loop(self):
+        if self.game_process is not None:
+            self.run_shared_loop()
+            return
+        if self.LOGIC_RATE > 0:
+            self.run_threaded_loop()
+            return
+        profiler = self.profiler
         while True:
+            profiler.start_frame()
             if not(self.exo_display.exo_active):
                 self.check_keys()
+            profiler.mark(0)
+            self.exo_display.update_inputs()
+            profiler.mark(1)
+            self.run_logic()
+            profiler.mark(2)
+            self.draw()
+            profiler.mark(3)
+            flip_time = self.win.flip()
+            profiler.mark(4)
+            profiler.end_frame(flip_time, self.run_num, self.execution_num,
+                              self.exo_display.frame_updates)
+
+    def run_logic_loop(self):
+        # input processing, state machine and logging at LOGIC_RATE, paced
+        # by run_at_rate (samples carry their own timestamps, so skipped
+        # ticks lose no input)
+        try:
+            run_at_rate(self.LOGIC_RATE, self.run_logic_tick, lambda: self.quit_requested)
+        except Exception:
+            traceback.print_exc()
+            self.quit_requested = True
+
+    def run_logic_tick(self):
+        with self.state_lock:
             self.exo_display.update_inputs()
-            if self.exp_stage == 'wait':
-                self.wait_for_start()
-            elif self.exp_stage == 'run':
-                self.run_trial()
-            self.exo_display.draw()
-            self.win.flip()
+            self.run_logic()
+
+    def run_threaded_loop(self):
+        # the render loop only reads keys, copies the latest state under
+        # state_lock and draws and flips after releasing it, so a slow frame
+        # never holds up the logic thread
+        self.exo_display.defer_stims()
+        self.logic_thread = threading.Thread(target=self.run_logic_loop,
+                                             name='logic', daemon=True)
+        self.logic_thread.start()
+        profiler = self.profiler
+        while not(self.quit_requested):
+            profiler.start_frame()
+            with self.state_lock:
+                if not(self.exo_display.exo_active):
+                    self.check_keys()
+                profiler.mark(0)
+                state = self.draw_state()
+            profiler.mark(1)
+            self.draw(state)
+            profiler.mark(2)
+            flip_time = self.win.flip()
+            profiler.mark(3)
+            profiler.end_frame(flip_time, self.run_num, self.execution_num,
+                              self.exo_display.frame_updates)
+        self.quit()
+
+    def run_shared_loop(self):
+        # the game process handles inputs, logic and logging; each frame
+        # takes its latest state from shared memory and draws it, until the
+        # session ends there
+        profiler = self.profiler
+        while not(self.game_process.finished()):
+            profiler.start_frame()
+            state = self.game_process.read_state(self)
+            profiler.mark(0)
+            self.draw(state)
+            profiler.mark(1)
+            flip_time = self.win.flip()
+            profiler.mark(2)
+            profiler.end_frame(flip_time, state['run_num'], state['execution_num'],
+                              self.exo_display.frame_updates)
+        self.quit()
 
     def quit(self):
-        self.frame_file.close()
+        if self.game_process is not None:
+            # the child closes its own logs and checkpoint
+            self.game_process.close()
+            self.profiler.close()
+            self.running = False
+            core.quit()
+            return
+        if self.logic_thread is not None:
+            if threading.current_thread() is self.logic_thread:
+                self.quit_requested = True # the render loop quits
+                return
+            self.quit_requested = True
+            self.logic_thread.join()
+        self.profiler.close()
+        if self.frame_log != 'csv':
+            self.frame_logger.close()
+            if self.frame_log == 'binary':
+                frame_bin_to_csv(self.subject_path)
+        else:
+            self.frame_file.close()
         self.trial_file.close()
-        if self.exo_display.exo_active:
-            self.exo_display.exo.stop()
-        core.quit()
+        self.summary_file.close()
+        self.checkpoint.close()
+        self.exo_display.close()
+        self.running = False
+        if not(self.headless):
+            core.quit()
 
 if __name__ == '__main__':
-    game = SequenceGame()
+    game = SequenceGame(parse_args())
     game.run_main_loop()
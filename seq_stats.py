@@ -0,0 +1,118 @@
+import math, heapq, bisect
+from collections import deque
+
+class RunningQuantile:
+    # exact running percentile (np.percentile's linear interpolation) with two
+    # heaps: low holds the floor((n-1)*q)+1 smallest values, high the rest;
+    # O(log n) per add, O(1) per query
+
+    def __init__(self, q):
+        if not(0 <= q <= 1):
+            raise ValueError('q should be in [0, 1]')
+        self.q = q
+        self.low = [] # max-heap, stored negated
+        self.high = [] # min-heap
+        self.count = 0
+
+    def add(self, value):
+        if self.low and value <= -self.low[0]:
+            heapq.heappush(self.low, -value)
+        else:
+            heapq.heappush(self.high, value)
+        self.count += 1
+        target = int(math.floor((self.count-1)*self.q))+1
+        while len(self.low) > target:
+            heapq.heappush(self.high, -heapq.heappop(self.low))
+        while len(self.low) < target:
+            heapq.heappush(self.low, -heapq.heappop(self.high))
+
+    def value(self):
+        if self.count == 0:
+            return math.nan
+        pos = (self.count-1)*self.q
+        frac = pos-math.floor(pos)
+        lower = -self.low[0]
+        if frac == 0 or not(self.high):
+            return lower
+        upper = self.high[0]
+        if self.q == 0.5:
+            return (lower+upper)/2 # as np.median
+        return lower+(upper-lower)*frac
+
+class WindowedQuantiles:
+    # percentiles of the last window values, kept sorted with bisect
+
+    def __init__(self, window):
+        self.window = int(window)
+        self.values = deque()
+        self.sorted = []
+
+    def add(self, value):
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+
+    def percentile(self, q):
+        n = len(self.sorted)
+        if n == 0:
+            return math.nan
+        pos = (n-1)*q
+        i = int(math.floor(pos))
+        frac = pos-i
+        if frac == 0:
+            return self.sorted[i]
+        if q == 0.5:
+            return (self.sorted[i]+self.sorted[i+1])/2
+        return self.sorted[i]+(self.sorted[i+1]-self.sorted[i])*frac
+
+    def median(self):
+        return self.percentile(0.5)
+
+    def mean(self):
+        return sum(self.values)/len(self.values) if self.values else math.nan
+
+class SequenceStats:
+    # online movement-time statistics for one sequence
+
+    def __init__(self, window=10, quantiles=(0.25, 0.5, 0.75), ema_alpha=0.2):
+        self.count = 0
+        self.quantiles = {q:RunningQuantile(q) for q in quantiles}
+        if 0.5 not in self.quantiles:
+            self.quantiles[0.5] = RunningQuantile(0.5)
+        self.recent = WindowedQuantiles(window)
+        self.ema_alpha = ema_alpha
+        self.ema = math.nan # exponential moving average (learning curve)
+        self.best = math.inf
+
+    def add(self, seq_time):
+        self.count += 1
+        for quantile in self.quantiles.values():
+            quantile.add(seq_time)
+        self.recent.add(seq_time)
+        if self.count == 1:
+            self.ema = seq_time
+        else:
+            self.ema += self.ema_alpha*(seq_time-self.ema)
+        self.best = min(self.best, seq_time)
+
+    def median(self):
+        return self.quantiles[0.5].value()
+
+    def percentile(self, q):
+        return self.quantiles[q].value()
+
+    def recent_median(self):
+        return self.recent.median()
+
+    def summary(self):
+        summary = {'count': self.count,
+                   'median': self.median(),
+                   'recent_median': self.recent_median(),
+                   'ema': self.ema,
+                   'best': self.best}
+        for q in sorted(self.quantiles):
+            if q != 0.5:
+                summary['p'+str(int(round(100*q)))] = self.quantiles[q].value()
+        return summary
@@ -0,0 +1,208 @@
+import time, ctypes, traceback
+import multiprocessing as mp
+import numpy as np
+from exo_input import run_at_rate
+
+# the experiment without its window in a child process: exo acquisition,
+# filtering, keydown detection, the trial state machine and the logs run
+# there at a fixed rate, and each tick's display state (angles, keydowns,
+# key positions and colours, cue, trial state) is published to a shared
+# memory block that the render process reads every frame without waiting
+# on the child. The block is a multiprocessing RawArray, which works on
+# python 3.7 (multiprocessing.shared_memory needs 3.8)
+
+HANDS = ['left', 'right']
+TEXT_BYTES = 64 # utf-8 bytes per text slot
+
+class SharedBlock:
+    # float64 slots: header, then angle_filt and keydowns per finger, then
+    # per key its ypos, key colour and base colour, then the cue outline and
+    # message colours; after those, text slots for the cue message, score
+    # text and run message. The writer holds SEQ odd while it writes
+    # (seqlock) and readers retry on change; STOP is written by the reader
+
+    (SEQ, STOP, READY, DONE, RESUMES, UPDATES, HAND, WAIT,
+     RUN, TRIAL, EXECUTION) = range(11)
+    HEADER = 11
+    KEY_SLOTS = 7 # ypos, key_color (3), base_color (3)
+    TEXTS = ('cue_msg', 'score_text', 'run_msg')
+
+    def __init__(self, num_fingers, num_keys, raw=None):
+        self.num_fingers = num_fingers
+        self.num_keys = num_keys
+        self.num_slots = self.HEADER+2*num_fingers+self.KEY_SLOTS*num_keys+6
+        size = 8*self.num_slots+TEXT_BYTES*len(self.TEXTS)
+        if raw is None:
+            raw = mp.get_context('spawn').RawArray(ctypes.c_ubyte, size)
+        self.raw = raw
+        buf = np.frombuffer(raw, dtype=np.uint8)
+        self.data = buf[:8*self.num_slots].view(np.float64)
+        self.texts = buf[8*self.num_slots:].reshape(len(self.TEXTS), TEXT_BYTES)
+        n = num_fingers
+        self.angle_filt = self.data[self.HEADER:self.HEADER+n]
+        self.keydowns = self.data[self.HEADER+n:self.HEADER+2*n]
+        start = self.HEADER+2*n
+        self.keys = self.data[start:start+self.KEY_SLOTS*num_keys].reshape(num_keys, self.KEY_SLOTS)
+        start += self.KEY_SLOTS*num_keys
+        self.outline_color = self.data[start:start+3]
+        self.msg_color = self.data[start+3:start+6]
+
+    def write(self, game):
+        # child side: publish the display and trial state of game
+        exo_display = game.exo_display
+        cue_display = exo_display.cue_display
+        data = self.data
+        data[self.SEQ] += 1
+        data[self.UPDATES] += exo_display.count_updates() # running total
+        data[self.HAND] = HANDS.index(cue_display.active_hand)
+        data[self.WAIT] = game.exp_stage == 'wait'
+        data[self.RUN] = game.run_num
+        data[self.TRIAL] = game.trial_num
+        data[self.EXECUTION] = game.execution_num
+        self.angle_filt[:] = exo_display.angle_filt
+        self.keydowns[:] = exo_display.keydowns
+        self.keys[:] = np.nan # never set
+        for key, stim in zip(self.keys, exo_display.key_stims):
+            values = stim.last_values
+            if 'ypos' in values:
+                key[0] = values['ypos']
+            if 'key_color' in values:
+                key[1:4] = values['key_color']
+            if 'base_color' in values:
+                key[4:7] = values['base_color']
+        self.outline_color[:] = cue_display.last_values.get('outline_color', [np.nan]*3)
+        self.msg_color[:] = cue_display.msg_color
+        for slot, text in zip(self.texts, [cue_display.msg_text, game.score_text,
+                                           game.run_msg.text]):
+            encoded = text.encode('utf-8')[:TEXT_BYTES]
+            slot[:] = 0
+            slot[:len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+        data[self.SEQ] += 1
+
+    def snapshot(self):
+        # render side: (numbers, texts) copied without tearing
+        while True:
+            seq = self.data[self.SEQ]
+            if seq % 2 == 0:
+                numbers = self.data.copy()
+                texts = [bytes(slot).rstrip(b'\0').decode('utf-8', 'ignore')
+                         for slot in self.texts]
+                if self.data[self.SEQ] == seq:
+                    return numbers, texts
+            time.sleep(0)
+
+def run_game(args, config_overrides, raw, rate):
+    # child process: a windowless SequenceGame ticked at rate Hz
+    from seq_exp import SequenceGame
+    block = None
+    game = None
+    try:
+        game = SequenceGame(args, headless=True,
+                            config_overrides=dict(config_overrides, shared_input=False))
+        block = SharedBlock(game.exo_display.num_fingers,
+                            len(game.exo_display.key_stims), raw)
+        block.data[block.RESUMES] = game.checkpoint.get('resumes')
+        block.write(game)
+        block.data[block.READY] = 1
+
+        def tick():
+            game.exo_display.update_inputs()
+            game.run_logic()
+            block.write(game)
+
+        run_at_rate(rate, tick, lambda: block.data[block.STOP] > 0 or not(game.running))
+    except Exception:
+        traceback.print_exc()
+    finally:
+        if game is not None and game.running:
+            game.quit() # closes the logs
+        if block is None:
+            block = SharedBlock(0, 0, raw) # header only, to signal the end
+        block.data[block.DONE] = 1
+
+class GameProcess:
+    # render side: starts run_game, waits until the session is set up and
+    # turns the block into the state SequenceGame.draw() takes
+
+    def __init__(self, args, config, config_overrides=None, rate=250):
+        # args and config_overrides are those of the render side's SequenceGame
+        self.config = config
+        self.num_fingers = config['num_fingers']
+        self.num_keys = config['num_active_fingers']
+        self.block = SharedBlock(self.num_fingers, self.num_keys)
+        self.updates_read = 0 # UPDATES total at the previous read_state
+        # spawned, not forked: the parent has a GL context and threads
+        context = mp.get_context('spawn')
+        self.process = context.Process(target=run_game, name='exo-game',
+            args=(args, config_overrides or {}, self.block.raw, rate), daemon=True)
+        self.process.start()
+
+    def wait_ready(self):
+        # until the child has connected the exo and opened the logs
+        block = self.block
+        while not(block.data[block.READY]):
+            if block.data[block.DONE] or not(self.process.is_alive()):
+                self.close()
+                raise RuntimeError('game process failed to start (exit code {})'.format(
+                    self.process.exitcode))
+            time.sleep(0.01)
+
+    def finished(self):
+        return bool(self.block.data[self.block.DONE])
+
+    def check(self):
+        if not(self.finished()) and not(self.process.is_alive()):
+            raise RuntimeError('game process stopped (exit code {})'.format(
+                self.process.exitcode))
+
+    def read_state(self, game):
+        # the state for game.draw(), with text stims from the render side's
+        # caches, plus the run and execution number for the profiler
+        self.check()
+        block = self.block
+        numbers, (cue_text, score_text, run_text) = block.snapshot()
+        exo_display = game.exo_display
+        cue_display = exo_display.cue_display
+        n = self.num_fingers
+        start = block.HEADER+2*n
+        keys = numbers[start:start+block.KEY_SLOTS*self.num_keys].reshape(
+            self.num_keys, block.KEY_SLOTS)
+        start += block.KEY_SLOTS*self.num_keys
+        outline_color = numbers[start:start+3]
+        msg_color = numbers[start+3:start+6]
+        key_values = []
+        for key in keys:
+            values = {}
+            if not(np.isnan(key[0])):
+                values['ypos'] = key[0]
+            if not(np.isnan(key[1])):
+                values['key_color'] = tuple(key[1:4])
+            if not(np.isnan(key[4])):
+                values['base_color'] = tuple(key[4:7])
+            key_values.append(values)
+        cue_values = {}
+        if not(np.isnan(outline_color[0])):
+            cue_values['outline_color'] = tuple(outline_color)
+        updates = int(numbers[block.UPDATES])-self.updates_read
+        self.updates_read += updates
+        return {'run_num': int(numbers[block.RUN]),
+                'execution_num': int(numbers[block.EXECUTION]),
+                'exp_stage': 'wait' if numbers[block.WAIT] else 'run',
+                'score_text': score_text,
+                'run_msg': game.run_msgs.get(run_text, exo_display.cue_color),
+                'exo_display': {'updates': updates,
+                                'keys': key_values,
+                                'cue': cue_values,
+                                'hand': HANDS[int(numbers[block.HAND])],
+                                'cue_msg': cue_display.text_cache.get(cue_text, tuple(msg_color))}}
+
+    def resumes(self):
+        return int(self.block.data[self.block.RESUMES])
+
+    def close(self):
+        # ask the child to stop, which closes its logs, and wait for it
+        self.block.data[self.block.STOP] = 1
+        self.process.join(timeout=5.0)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -0,0 +1,78 @@
+import time, threading
+
+class BackgroundTask:
+    # runs func(*args) on a thread; result() waits for it and re-raises errors
+
+    def __init__(self, func, *args, **kwargs):
+        self.value = None
+        self.error = None
+        self.start_time = time.perf_counter()
+        self.duration = None
+        self.thread = threading.Thread(target=self.run, args=(func, args, kwargs),
+                                       name='startup-'+func.__name__, daemon=True)
+        self.thread.start()
+
+    def run(self, func, args, kwargs):
+        try:
+            self.value = func(*args, **kwargs)
+        except BaseException as e:
+            self.error = e
+        self.duration = time.perf_counter()-self.start_time
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class StartupTimer:
+    # wall time of each start-up stage, plus the run time of background tasks
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages = []
+
+    def stage(self, name):
+        return StartupStage(self, name)
+
+    def add(self, name, duration):
+        self.stages.append((name, duration))
+
+    def add_task(self, name, task):
+        task.result()
+        self.add(name+' (background)', task.duration)
+
+    def report(self, path=None):
+        total = time.perf_counter()-self.start_time
+        lines = ['{:<28} {:8.3f} s'.format(name, duration) for name, duration in self.stages]
+        lines.append('{:<28} {:8.3f} s'.format('total', total))
+        text = '\n'.join(lines)
+        print(text)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text+'\n')
+        return text
+
+class StartupStage:
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter()-self.start_time)
+        return False
+
+def load_images(paths):
+    # decode images off the main thread; ImageStim accepts the PIL images
+    from PIL import Image
+    images = {}
+    for path in paths:
+        image = Image.open(path)
+        image.load()
+        images[path] = image
+    return images